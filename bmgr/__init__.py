@@ -1,7 +1,8 @@
 import os
+import click
 
 from flask import Flask
-from . import server
+from . import server, migrations
 
 def create_app(test_config=None):
     # create and configure the app
@@ -34,6 +35,13 @@ def create_app(test_config=None):
                              "or URI")
 
     app.config.setdefault('BMGR_TEMPLATE_PATH', '/etc/bmgr/templates/')
+    app.config.setdefault('BMGR_TEMPLATE_AUTO_RELOAD', True)
+    app.config.setdefault('BMGR_TEMPLATE_BYTECODE_CACHE', False)
+    app.config.setdefault('BMGR_ATTRIBUTES_CACHE_SIZE', 1024)
+    app.config.setdefault('BMGR_RENDER_CACHE_SIZE', 16 * 1024 * 1024)
+    app.config.setdefault('BMGR_DEEP_MERGE', False)
+    app.config.setdefault('BMGR_RENDER_PROCESSES', 0)
+    app.config.setdefault('BMGR_RENDER_PYTHON', None)
     app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'pool_recycle' : 600})
     app.config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', False)
     app.register_blueprint(server.bp)
@@ -46,9 +54,26 @@ def create_app(test_config=None):
 
     # Initialize the SQLAlchemy db object
     server.db.init_app(app)
+    server.init_app(app)
 
     @app.cli.command(help='Intialize the bmgr database')
     def initdb():
         server.init_db()
 
+    @app.cli.command(help='Upgrade the schema of an existing bmgr database')
+    @click.option('--batch-size', default=server.CHUNK_SIZE,
+                  help='Number of rows migrated per transaction')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only list the pending migrations')
+    def upgradedb(batch_size, dry_run):
+        pending = migrations.pending_migrations()
+        if not pending:
+            click.echo('Database schema is up to date (version {})'.format(
+                migrations.current_version()))
+
+        for m in pending:
+            click.echo('Migration {}: {}'.format(m.version, m.description))
+            if not dry_run:
+                migrations.apply_migration(m, batch_size)
+
     return app
@@ -0,0 +1,216 @@
+""" Asynchronous client for the bmgr API, built on aiohttp
+
+It offers the same methods as bmgr.client.Client as coroutines, so that
+scripts can drive many requests concurrently over a shared connection pool:
+
+    async with AsyncClient('http://bmgr/') as c:
+        await asyncio.gather(*[c.render_resource('boot', h) for h in hosts])
+"""
+import asyncio
+import json
+
+import aiohttp
+
+from bmgr.client import BaseClient
+
+class AsyncClient(BaseClient):
+    """ limit is the size of the connection pool and concurrency the maximum
+    number of requests in flight. Idempotent requests failing with a server
+    error, a connection error or a timeout are retried up to retries times,
+    waiting backoff seconds before the first retry and twice as long before
+    each next one.
+
+    Other requests (writes, and renders which consume oneshot overrides) may
+    have been applied by the server even if their response was lost, so they
+    are only retried when the connection could not be established, unless
+    retry_writes is set """
+
+    def __init__(self, base_url, limit=100, concurrency=100, retries=3,
+                 backoff=0.1, timeout=300, retry_writes=False):
+        super(AsyncClient, self).__init__(base_url)
+        self.limit = limit
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.retry_writes = retry_writes
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # The session and the semaphore are bound to the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        return self._session
+
+    def _validate_resp(self, r, body):
+        if r.status >= 400:
+            try:
+                message = json.loads(body.decode('utf-8'))['error']
+            except (ValueError, KeyError, TypeError):
+                message = r.reason
+
+            raise aiohttp.ClientResponseError(
+                r.request_info, r.history, status=r.status, message=message,
+                headers=r.headers)
+
+    async def _request(self, method, url, text=False, idempotent=None,
+                       **kwargs):
+        if idempotent is None:
+            idempotent = method == 'GET'
+        retry = idempotent or self.retry_writes
+
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self._semaphore:
+                    async with session.request(method, url, **kwargs) as r:
+                        body = await r.read()
+
+                if r.status < 500 or not retry or last:
+                    self._validate_resp(r, body)
+                    if text:
+                        return body.decode('utf-8')
+                    return json.loads(body.decode('utf-8')) if body else None
+            except aiohttp.ClientConnectorError:
+                # The request was never sent
+                if last:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not retry or last:
+                    raise
+
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _iter_request(self, method, url, **kwargs):
+        """ Yields the items of a newline-delimited JSON response. Streams
+        are not retried once they have started """
+        session = self._get_session()
+        async with self._semaphore:
+            async with session.request(method, url, **kwargs) as r:
+                if r.status >= 400:
+                    self._validate_resp(r, await r.read())
+
+                if not r.content_type == 'application/x-ndjson':
+                    for item in await r.json():
+                        yield item
+                    return
+
+                async for line in r.content:
+                    if line.strip():
+                        yield json.loads(line.decode('utf-8'))
+
+    async def get_hosts(self, hosts=None, where=None):
+        return await self._request('GET', self._url('hosts', hosts),
+                                   params=self._where_params(where))
+
+    def iter_hosts(self, hosts=None, where=None):
+        params = dict(self._where_params(where) or {}, format='ndjson')
+        return self._iter_request('GET', self._url('hosts', hosts),
+                                  params=params)
+
+    async def add_hosts(self, nodeset, profiles):
+        return await self._request('POST', self._url('hosts'),
+                                   json=self._hosts_req(nodeset, profiles))
+
+    async def update_hosts(self, nodeset, profiles):
+        return await self._request('PATCH', self._url('hosts', str(nodeset)),
+                                   json={'profiles': profiles})
+
+    async def del_hosts(self, nodeset):
+        return await self._request('DELETE', self._url('hosts', str(nodeset)))
+
+    async def get_profiles(self):
+        return await self._request('GET', self._url('profiles'))
+
+    async def add_profile(self, profile, attrs=None, weight=None):
+        return await self._request(
+            'POST', self._url('profiles'),
+            json=self._profile_req(profile, attrs, weight))
+
+    async def get_profile(self, profile):
+        return await self._request('GET', self._url('profiles', profile))
+
+    async def del_profile(self, profile):
+        return await self._request('DELETE', self._url('profiles', profile))
+
+    async def update_profile(self, profile, attrs=None, weight=None,
+                             version=None):
+        return await self._request(
+            'PATCH', self._url('profiles', profile),
+            json=self._profile_req(profile, attrs, weight),
+            headers=self._patch_headers(version))
+
+    async def add_resource(self, resource, template):
+        return await self._request(
+            'POST', self._url('resources'),
+            json=self._resource_req(resource, template))
+
+    async def get_resources(self, resource=None):
+        return await self._request('GET', self._url('resources', resource))
+
+    async def del_resource(self, resource):
+        return await self._request('DELETE', self._url('resources', resource))
+
+    async def update_resource(self, resource, template):
+        return await self._request(
+            'PATCH', self._url('resources', resource),
+            json=self._resource_req(resource, template))
+
+    async def render_resource(self, resource, host):
+        # Rendering consumes oneshot overrides
+        return await self._request('GET',
+                                   self._url('resources', resource, host),
+                                   text=True, idempotent=False)
+
+    def render_resources(self, resource, hosts, dry_run=False):
+        return self._iter_request(
+            'POST', self._url('resources', resource, 'render'),
+            json={'hosts': str(hosts), 'dry_run': dry_run})
+
+    async def batch(self, operations):
+        return await self._request('POST', self._url('batch'),
+                                   json=self._batch_req(operations))
+
+    async def export_inventory(self):
+        return await self._request('GET', self._url('inventory'))
+
+    async def import_inventory(self, inventory, dry_run=False):
+        return await self._request(
+            'PUT', self._url('inventory'), json=inventory,
+            params={'dry_run': 'true'} if dry_run else None)
+
+    async def get_aliases(self, alias=None):
+        return await self._request('GET', self._url('aliases', alias))
+
+    async def add_alias(self, alias, target):
+        return await self._request('POST', self._url('aliases'),
+                                   json=self._alias_req(alias, target))
+
+    async def del_alias(self, alias):
+        return await self._request('DELETE', self._url('aliases', alias))
+
+    async def add_override(self, alias, hosts, target, oneshot):
+        return await self._request(
+            'POST', self._url('aliases', alias),
+            json=self._override_req(hosts, target, oneshot))
+
+    async def restore_alias(self, alias, hosts):
+        return await self._request('DELETE',
+                                   self._url('aliases', alias, hosts))
@@ -1,11 +1,16 @@
+import hashlib
+import json
+import os
+import tempfile
 import requests
 
-class Client(object):
+class BaseClient(object):
+    """ Builds the URLs and payloads of API requests """
+
     def __init__(self, base_url):
         if base_url.endswith('/'):
             base_url = base_url[:-1]
         self._base_url = base_url
-        self._s = requests.Session()
 
     def _url(self, view, res=None, subres=None):
         view_url = '{}/api/v1.0/{}'.format(self._base_url, view)
@@ -21,14 +26,6 @@ class Client(object):
             return view_url
 
 
-    def _validate_resp(self, r):
-        r.raise_for_status()
-
-        if r.text:
-            return r.json()
-        else:
-            return None
-
     def _hosts_req(self, nodeset, profiles):
         json = {'name': str(nodeset)}
         if profiles:
@@ -73,9 +70,127 @@ class Client(object):
 
         return json
 
-    def get_hosts(self, hosts=None):
-        r = self._s.get(self._url('hosts', hosts))
-        return self._validate_resp(r)
+    def _where_params(self, where):
+        if not where:
+            return None
+
+        return {'where': ['{}={}'.format(k, v) for k, v in where]}
+
+    def _batch_req(self, operations):
+        # Paths may be given relative to the API root, as in 'hosts/node1'
+        ops = []
+        for op in operations:
+            op = dict(op)
+            if not op['path'].startswith('/'):
+                op['path'] = '/api/v1.0/' + op['path']
+            ops.append(op)
+
+        return {'operations': ops}
+
+    def _patch_headers(self, version):
+        # Attributes set to None in the request are deleted by the merge patch
+        headers = {'Content-Type': 'application/merge-patch+json'}
+        if version is not None:
+            headers['If-Match'] = '"{}"'.format(version)
+
+        return headers
+
+
+class ResponseCache(object):
+    """ Keeps GET responses on disk with their ETag, so that they can be
+    revalidated with a conditional request """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, url, params):
+        key = json.dumps([url, params], sort_keys=True)
+        return os.path.join(self.path,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, url, params):
+        try:
+            with open(self._file(url, params)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def set(self, url, params, r):
+        entry = {'etag': r.headers['ETag'],
+                 'content_type': r.headers.get('Content-Type', ''),
+                 'text': r.text}
+
+        # Concurrent clients never read partially written entries
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._file(url, params))
+
+
+class Client(BaseClient):
+    """ If cache_dir is set, responses to GET requests are kept in this
+    directory and only transferred again when they changed on the server """
+
+    def __init__(self, base_url, cache_dir=None):
+        super(Client, self).__init__(base_url)
+        self._s = requests.Session()
+        self._cache = ResponseCache(cache_dir) if cache_dir else None
+
+    def _get(self, url, params=None, stream=False):
+        if self._cache is None:
+            return self._s.get(url, params=params, stream=stream)
+
+        entry = self._cache.get(url, params)
+        headers = {}
+        if entry is not None:
+            headers['If-None-Match'] = entry['etag']
+
+        r = self._s.get(url, params=params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            r.status_code = 200
+            r.headers['Content-Type'] = entry['content_type']
+            r.encoding = 'utf-8'
+            r._content = entry['text'].encode('utf-8')
+        elif r.status_code == 200 and 'ETag' in r.headers:
+            self._cache.set(url, params, r)
+
+        return r
+
+
+    def _validate_resp(self, r):
+        r.raise_for_status()
+
+        if r.text:
+            return r.json()
+        else:
+            return None
+
+    def _iter_resp(self, r):
+        r.raise_for_status()
+
+        # Servers without streaming support answer with a plain JSON list
+        if r.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        else:
+            for item in r.json():
+                yield item
+
+    def _get_list(self, url, stream, params=None):
+        params = dict(params or {})
+        if not stream:
+            return self._validate_resp(self._get(url, params))
+
+        params['format'] = 'ndjson'
+        r = self._get(url, params, stream=True)
+        return self._iter_resp(r)
+
+    def get_hosts(self, hosts=None, stream=False, where=None):
+        return self._get_list(self._url('hosts', hosts), stream,
+                              self._where_params(where))
 
     def add_hosts(self, nodeset, profiles):
         r = self._s.post(
@@ -98,7 +213,7 @@ class Client(object):
         return self._validate_resp(r)
 
     def get_profiles(self):
-        r = self._s.get(self._url('profiles'))
+        r = self._get(self._url('profiles'))
         return self._validate_resp(r)
 
     def add_profile(self, profile, attrs=None, weight=None):
@@ -109,7 +224,7 @@ class Client(object):
         return self._validate_resp(r)
 
     def get_profile(self, profile):
-        r = self._s.get(
+        r = self._get(
             self._url('profiles', profile),
         )
 
@@ -121,26 +236,11 @@ class Client(object):
         )
         return self._validate_resp(r)
 
-    def update_profile(self, profile, attrs=None, weight=None):
-        if attrs:
-            cur_profile = self._s.get(
-                self._url('profiles', profile),
-            )
-            cur_profile = self._validate_resp(cur_profile)
-
-            new_attrs = cur_profile['attributes']
-
-            for k, v in attrs:
-                if v is None:
-                    del new_attrs[k]
-                else:
-                    new_attrs[k] = v
-
-            attrs = new_attrs
-
+    def update_profile(self, profile, attrs=None, weight=None, version=None):
         r = self._s.patch(
             self._url('profiles', profile),
-            json = self._profile_req(profile, attrs, weight)
+            json = self._profile_req(profile, attrs, weight),
+            headers = self._patch_headers(version)
         )
         return self._validate_resp(r)
 
@@ -152,7 +252,7 @@ class Client(object):
         return self._validate_resp(r)
 
     def get_resources(self, resource=None):
-        r = self._s.get(
+        r = self._get(
             self._url('resources', resource),
         )
 
@@ -180,13 +280,45 @@ class Client(object):
         r.raise_for_status()
         return r.text
 
-    def get_aliases(self, alias=None):
-        r = self._s.get(
-            self._url('aliases', alias),
+    def render_resources(self, resource, hosts, dry_run=False):
+        r = self._s.post(
+            self._url('resources', resource, 'render'),
+            json = {'hosts': str(hosts), 'dry_run': dry_run},
+            stream = True
         )
+        return self._iter_resp(r)
 
+    def batch(self, operations):
+        """ Runs operations, given as dicts with a method, a path, an
+        optional body and optional Content-Type and If-Match headers, in a
+        single transaction. Returns their results """
+        r = self._s.post(
+            self._url('batch'),
+            json = self._batch_req(operations)
+        )
+        return self._validate_resp(r)
+
+    def export_inventory(self):
+        """ Returns all the profiles, resources, hosts and aliases """
+        r = self._get(self._url('inventory'))
+        return self._validate_resp(r)
+
+    def import_inventory(self, inventory, dry_run=False):
+        """ Replaces the inventory of the server and returns the number of
+        objects added, updated and deleted of each kind """
+        r = self._s.put(
+            self._url('inventory'),
+            json = inventory,
+            params = {'dry_run': 'true'} if dry_run else None
+        )
         return self._validate_resp(r)
 
+    def get_aliases(self, alias=None, stream=False):
+        if alias:
+            stream = False
+
+        return self._get_list(self._url('aliases', alias), stream)
+
     def add_alias(self, alias, target):
         r = self._s.post(
             self._url('aliases'),
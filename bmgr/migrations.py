@@ -0,0 +1,150 @@
+""" Versioned migrations of the bmgr database schema
+
+Each migration brings the schema from the previous version to its own. Data
+is migrated in batches committed separately and indexes are created online
+when the database supports it, so migrations can be applied to a populated
+database without long table locks.
+"""
+import collections
+
+from sqlalchemy import func, inspect
+
+from .server import (
+  db, schema_version_table, host_profiles_table, change_counters_table,
+  init_counters, Alias, Profile, new_version
+)
+
+Migration = collections.namedtuple('Migration',
+                                   ['version', 'description', 'upgrade'])
+
+MIGRATIONS = []
+
+def migration(version, description):
+  def decorator(func):
+    MIGRATIONS.append(Migration(version, description, func))
+    MIGRATIONS.sort(key=lambda m: m.version)
+    return func
+
+  return decorator
+
+def latest_version():
+  return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+def current_version():
+  if schema_version_table.name not in inspect(db.engine).get_table_names():
+    return 0
+
+  return db.session.query(
+    func.max(schema_version_table.c.version)).scalar() or 0
+
+def set_version(version):
+  schema_version_table.create(db.engine, checkfirst=True)
+  db.session.execute(schema_version_table.delete())
+  db.session.execute(schema_version_table.insert(), {'version': version})
+
+def pending_migrations():
+  version = current_version()
+  return [m for m in MIGRATIONS if m.version > version]
+
+def apply_migration(m, batch_size):
+  m.upgrade(batch_size)
+  set_version(m.version)
+  db.session.commit()
+
+def upgrade_db(batch_size=1000):
+  """ Applies all the pending migrations, returns the applied ones """
+  applied = []
+  for m in pending_migrations():
+    apply_migration(m, batch_size)
+    applied.append(m)
+
+  return applied
+
+def index_names(table):
+  return set(i['name'] for i in inspect(db.engine).get_indexes(table.name))
+
+def create_index(index):
+  """ Creates an index, without locking the table on MySQL """
+  if index.name in index_names(index.table):
+    return
+
+  if db.engine.dialect.name == 'mysql':
+    db.session.execute(
+      'ALTER TABLE {} ADD {}INDEX {} ({}), ALGORITHM=INPLACE, LOCK=NONE'.format(
+        index.table.name, 'UNIQUE ' if index.unique else '', index.name,
+        ', '.join(c.name for c in index.columns)))
+  else:
+    index.create(db.engine)
+
+def column_names(table):
+  return set(c['name'] for c in inspect(db.engine).get_columns(table.name))
+
+def add_column(column):
+  """ Adds a nullable column, without locking the table on MySQL """
+  if column.name in column_names(column.table):
+    return
+
+  ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+    column.table.name, column.name,
+    column.type.compile(dialect=db.engine.dialect))
+  if db.engine.dialect.name == 'mysql':
+    ddl += ', ALGORITHM=INPLACE, LOCK=NONE'
+
+  db.session.execute(ddl)
+
+def get_index(table, name):
+  return [i for i in table.indexes if i.name == name][0]
+
+@migration(1, 'Index host/profile associations and alias lookups')
+def add_lookup_indexes(batch_size):
+  # Duplicated associations must be removed before creating the unique
+  # index: the associations of hosts with duplicates are rewritten in batches
+  c = host_profiles_table.c
+  while True:
+    host_ids = [h for (h,) in db.session.query(c.host_id).\
+                group_by(c.host_id, c.profile_id).having(func.count() > 1).\
+                limit(batch_size)]
+    if not host_ids:
+      break
+
+    rows = db.session.query(c.host_id, c.profile_id).distinct().\
+      filter(c.host_id.in_(host_ids)).all()
+    db.session.execute(host_profiles_table.delete().where(
+      c.host_id.in_(host_ids)))
+    db.session.execute(host_profiles_table.insert(),
+                       [{'host_id': h, 'profile_id': p} for h, p in rows])
+    db.session.commit()
+
+  for name in ('ix_host_profiles_host_profile',
+               'ix_host_profiles_profile_id'):
+    create_index(get_index(host_profiles_table, name))
+
+  for name in ('ix_aliases_host_id', 'ix_aliases_target_id'):
+    create_index(get_index(Alias.__table__, name))
+
+@migration(2, 'Store profile attributes as JSON and version profiles')
+def add_profile_versions(batch_size):
+  profiles = Profile.__table__
+  add_column(profiles.c.version)
+
+  while True:
+    ids = [i for (i,) in db.session.query(profiles.c.id).\
+           filter(profiles.c.version==None).limit(batch_size)]
+    if not ids:
+      break
+
+    for i in ids:
+      db.session.execute(profiles.update().where(profiles.c.id==i).\
+                         values(version=new_version()))
+    db.session.commit()
+
+  # SQLite stores JSON as text and needs no conversion
+  if db.engine.dialect.name == 'mysql':
+    db.session.execute('ALTER TABLE profiles '
+                       'MODIFY version VARCHAR(32) NOT NULL, '
+                       'MODIFY attributes JSON')
+
+@migration(3, 'Add change counters')
+def add_change_counters(batch_size):
+  change_counters_table.create(db.engine, checkfirst=True)
+  init_counters()
@@ -1,9 +1,11 @@
 import os
 import subprocess
 import click
+import json
 import re
 import requests
 import sys
+import yaml
 
 from bmgr.client import Client
 from ClusterShell.NodeSet import NodeSet
@@ -30,7 +32,7 @@ def get_client():
         conf_path = os.path.join(conf_path, 'bmgr.conf')
         base_url = parse_config(conf_path)
 
-    return Client(base_url)
+    return Client(base_url, os.environ.get('BMGR_CLIENT_CACHE', None))
 
 
 valid_identifier=r'^[A-Za-z0-9_\-\.]+$'
@@ -67,6 +69,19 @@ def validate_attrs(attrs):
 
     return attrs
 
+def validate_where(where):
+    if not where:
+        return None
+
+    clauses = []
+    for w in where:
+        key, sep, value = w.partition('=')
+        if not sep:
+            raise ValidationError('Invalid attribute filter ({}), expected KEY=VALUE'.format(w))
+        clauses.append((key, value))
+
+    return validate_attrs(clauses)
+
 def validate_resource(res):
     if not res:
         raise ValidationError('Empty resource identifier')
@@ -134,11 +149,13 @@ def print_host_list(host_list):
     click.echo(table.draw())
 
 @host.command(name='list')
+@click.option('-w', '--where', multiple=True, nargs=1,
+              help='only list hosts whose attribute KEY=VALUE (multiple options allowed)')
 @handle_exceptions()
-def hosts_list():
+def hosts_list(where):
     """ List hosts """
     c = get_client()
-    host_list = c.get_hosts()
+    host_list = c.get_hosts(stream=True, where=validate_where(where))
     print_host_list(host_list)
 
 
@@ -402,24 +419,53 @@ bmgr resource del ipxe_boot
     c.del_resource(resource)
 
 @resource.command(name='render', short_help='Render resources')
+@click.option('-n', '--dry-run', is_flag=True,
+              help='do not consume oneshot aliases')
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False),
+              help='write each rendered resource to a file named after the host')
 @click.argument('resource', nargs=1, type=str)
-@click.argument('host', nargs=1, type=str)
+@click.argument('nodeset', nargs=1, type=NodeSet)
 @handle_exceptions()
-def resources_render(resource, host):
+def resources_render(dry_run, output_dir, resource, nodeset):
     """ Render resources
 
-Render a resource for the specified host.
+Render a resource for the specified hosts. Several hosts are rendered with
+a single request.
 
-Warning: this will consume oneshot aliases
+Warning: this will consume oneshot aliases unless --dry-run is set
 
 Example usage:
 
 bmgr resource render ipxe_boot node100
 
+bmgr resource render --dry-run -o /tmp/ks kickstart node[1-5000]
+
 """
-    validate_hosts([host])
+    validate_hosts(nodeset)
     c = get_client()
-    click.echo(c.render_resource(resource, host))
+
+    if len(nodeset) == 1 and not dry_run and not output_dir:
+        click.echo(c.render_resource(resource, str(nodeset)))
+        return
+
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    failed = False
+    for r in c.render_resources(resource, nodeset, dry_run):
+        if 'error' in r:
+            click.secho('ERROR - {}: {}'.format(r['name'], r['error']),
+                        fg='red', err=True)
+            failed = True
+        elif output_dir:
+            with open(os.path.join(output_dir, r['name']), 'w') as f:
+                f.write(r['output'])
+        else:
+            click.echo('==> {} ({}) <=='.format(r['name'], r['resource']))
+            click.echo(r['output'])
+
+    if failed:
+        sys.exit(1)
 
 @cli.group(short_help='List and manage aliases')
 def alias():
@@ -534,4 +580,117 @@ bmgr alias restore boot node[0-4]
     c = get_client()
     c.restore_alias(alias, hosts)
 
+@cli.command(name='apply', short_help='Apply a batch of operations')
+@click.argument('file', nargs=1, type=click.File('r'))
+@handle_exceptions()
+def apply(file):
+    """ Apply a batch of operations from a JSON or YAML file ('-' for the
+standard input). Either all the operations succeed or none is applied.
+
+Each operation has a method (POST, PATCH or DELETE), the path of a route
+of the API, absolute or relative to /api/v1.0/, and the body and the
+Content-Type and If-Match headers of the request if any:
+
+\b
+operations:
+  - method: POST
+    path: profiles
+    body: {name: deploy, attributes: {os: el8}, weight: 10}
+  - method: PATCH
+    path: hosts/node[0-4]
+    body: {profiles: [compute, deploy]}
+  - method: PATCH
+    path: profiles/compute
+    body: {attributes: {kernel: null}}
+    headers: {Content-Type: application/merge-patch+json}
+  - method: POST
+    path: aliases/ipxe_boot
+    body: {hosts: 'node[0-4]', target: ipxe_deploy_boot, autodelete: true}
+
+Example usage:
+
+bmgr apply redeploy.yaml
+
+"""
+    try:
+        operations = yaml.safe_load(file)
+    except yaml.YAMLError as e:
+        raise ValidationError('Invalid batch file ({})'.format(e))
+
+    if isinstance(operations, dict):
+        operations = operations.get('operations')
+
+    if not isinstance(operations, list) or \
+       not all(isinstance(op, dict) and 'method' in op and 'path' in op and
+               isinstance(op.get('headers', {}), dict)
+               for op in operations):
+        raise ValidationError('Invalid batch file (expected a list of '
+                              'operations with a method, a path and '
+                              'optional headers)')
+
+    c = get_client()
+    results = c.batch(operations)
+    click.echo('{} operations applied'.format(len(results)))
+
+@cli.command(name='export', short_help='Export the whole inventory')
+@click.option('-f', '--format', 'fmt', type=click.Choice(['json', 'yaml']),
+              default='json', help='output format')
+@click.argument('output', nargs=1, type=click.File('w'), default='-')
+@handle_exceptions()
+def export(fmt, output):
+    """ Export all the profiles, resources, hosts and aliases to a JSON or
+YAML document (on the standard output by default), which can be restored
+with bmgr import
+
+Example usage:
+
+bmgr export -f yaml inventory.yaml
+
+"""
+    c = get_client()
+    inventory = c.export_inventory()
+
+    if fmt == 'yaml':
+        yaml.safe_dump(inventory, output, default_flow_style=False)
+    else:
+        json.dump(inventory, output, indent=2)
+        output.write('\n')
+
+@cli.command(name='import', short_help='Import a whole inventory')
+@click.option('-n', '--dry-run', is_flag=True,
+              help='only show the changes which would be applied')
+@click.argument('file', nargs=1, type=click.File('r'))
+@handle_exceptions()
+def import_(dry_run, file):
+    """ Replace all the profiles, resources, hosts and aliases with the
+content of a JSON or YAML document, as written by bmgr export ('-' for the
+standard input). Objects missing from the document are deleted. Only the
+differences are applied, in a single transaction.
+
+Example usage:
 
+bmgr import --dry-run inventory.yaml
+
+"""
+    try:
+        inventory = yaml.safe_load(file)
+    except yaml.YAMLError as e:
+        raise ValidationError('Invalid inventory file ({})'.format(e))
+
+    if not isinstance(inventory, dict):
+        raise ValidationError('Invalid inventory file (expected profiles, '
+                              'resources, hosts and aliases)')
+
+    c = get_client()
+    changes = c.import_inventory(inventory, dry_run)
+
+    table = Texttable(max_width=COLUMNS)
+    table.set_deco(Texttable.HEADER | Texttable.HLINES)
+    table.set_cols_dtype(['t', 'i', 'i', 'i'])
+    table.set_cols_align(['l', 'r', 'r', 'r'])
+    table.add_rows([['Objects', 'Added', 'Updated', 'Deleted']] +
+                   [[kind, changes[kind]['added'], changes[kind]['updated'],
+                     changes[kind]['deleted']]
+                    for kind in ('resources', 'profiles', 'hosts', 'aliases',
+                                 'overrides') if kind in changes])
+    click.echo(table.draw())
@@ -1,19 +1,36 @@
 from flask import (
-  Flask, Blueprint, jsonify, make_response, abort, request, g, current_app
+  Flask, Blueprint, jsonify, make_response, abort, request, g, current_app,
+  stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import joinedload, relationship, synonym, validates
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import (
+  aliased, deferred, joinedload, relationship, synonym, undefer, validates
+)
+from sqlalchemy.orm.exc import NoResultFound, StaleDataError
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import UniqueConstraint, and_
+from sqlalchemy import (
+  UniqueConstraint, and_, bindparam, func, inspect, literal, select
+)
+from sqlalchemy.ext import baked
 from flask_expects_json import expects_json
 from ClusterShell import NodeSet
 from ClusterShell.NodeSet import NodeSet as nodeset
 
 import subprocess, tempfile, os, stat, flask, json, jinja2, sys, itertools, time
-import re
+import re, threading, collections, hashlib, uuid, copy, multiprocessing
+import datetime, functools
+from jinja2 import meta
 
 MAX_NODESET = 100000
+# Number of rows handled by each set-based statement
+CHUNK_SIZE = 1000
+# Number of times an update losing a race with a concurrent one is retried
+UPDATE_RETRIES = 3
+# Maximum number of operations in a batch
+MAX_BATCH = 10000
+# Endpoints which cannot run as an operation of a batch
+BATCH_EXCLUDED = ('main.api_resources_resource_render_batch',
+                  'main.api_cache_delete', 'main.api_batch_post')
 
 bp = Blueprint('main', __name__)
 db = SQLAlchemy()
@@ -22,29 +39,55 @@ host_profiles_table = db.Table('host_profiles',
                                db.Column('host_id', db.Integer,
                                          db.ForeignKey('hosts.id')),
                                db.Column('profile_id', db.Integer,
-                                         db.ForeignKey('profiles.id'))
+                                         db.ForeignKey('profiles.id'),
+                                         index=True),
+                               db.Index('ix_host_profiles_host_profile',
+                                        'host_id', 'profile_id', unique=True)
                                )
 
+schema_version_table = db.Table('schema_version',
+                                db.Column('version', db.Integer,
+                                          nullable=False))
+
+# One row per kind of object, updated in the same transaction as each change
+change_counters_table = db.Table('change_counters',
+                                 db.Column('name', db.String(32),
+                                           primary_key=True),
+                                 db.Column('counter', db.Integer,
+                                           nullable=False, default=0),
+                                 db.Column('modified', db.DateTime,
+                                           nullable=False))
+CHANGE_COUNTERS = ('hosts', 'profiles', 'resources', 'aliases')
+
+def new_version(*args):
+  return uuid.uuid4().hex
+
 class Profile(db.Model):
   __tablename__ = 'profiles'
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(255), unique=True)
   weight = db.Column(db.Integer, default=0)
-  _attributes = db.Column('attributes', db.String(8000))
+  # Attributes are only loaded when their merged value is not cached
+  _attributes = deferred(db.Column('attributes', db.JSON))
+  # Changes each time the profile is updated
+  version = db.Column(db.String(32), nullable=False, default=new_version)
+
+  __mapper_args__ = {'version_id_col': version,
+                     'version_id_generator': new_version}
 
   @property
   def attributes(self):
-    return json.loads(self._attributes)
+    return dict(self._attributes or {})
 
   @attributes.setter
   def attributes(self, value):
-    self._attributes = json.dumps(value)
+    self._attributes = dict(value)
 
   attributes = synonym('_attributes', descriptor=attributes)
 
   def __init__(self, name, attributes={}, weight=0):
       self.name = name
-      self._attributes = json.dumps(attributes)
+      self.attributes = attributes
       self.weight = weight
 
   def __repr__(self):
@@ -63,9 +106,36 @@ class Profile(db.Model):
   def __lt__(self, other):
     return (- self.weight, self.name) < (- other.weight, other.name)
 
+def profile_merge_order(profile):
+  """ Profiles are merged by increasing weight: the heaviest one wins """
+  return (profile.weight, profile.name)
+
 def json_abort(status, error):
   abort(make_response(jsonify(error=error), status))
 
+def in_batch():
+  return g.get('batch', False)
+
+def commit():
+  """ Commits the changes of a request. The operations of a batch are only
+  flushed, to be committed all at once """
+  if in_batch():
+    db.session.flush()
+  else:
+    db.session.commit()
+
+def wants_ndjson():
+  return request.args.get('format') == 'ndjson'
+
+def ndjson_response(items):
+  """ Streams items as newline-delimited JSON """
+  def generate():
+    for item in items:
+      yield json.dumps(item) + '\n'
+
+  return current_app.response_class(stream_with_context(generate()),
+                                    mimetype='application/x-ndjson')
+
 
 def parse_template_uri(uri):
   m = re.match('file://(.*)', uri)
@@ -80,7 +150,8 @@ class Host(db.Model):
   hostname = db.Column(db.String(255), unique=True)
 
   profiles = relationship("Profile", backref="host",
-                       secondary=host_profiles_table, order_by=Profile.weight)
+                       secondary=host_profiles_table,
+                       order_by=(Profile.weight, Profile.name))
 
   aliases = relationship("Alias", backref="host", cascade="all, delete-orphan")
 
@@ -97,21 +168,72 @@ class Host(db.Model):
 
     return r
 
-  @classmethod
-  def from_dict(cls, d):
-    host = cls(d['name'])
-    if 'profiles' in d:
-      host.profiles = [ get_profile(p) for p in d['profiles'] ]
+def deep_merge(base, override):
+    """ Returns base updated with override: nested dicts are merged
+    recursively, lists and other values are replaced """
+    merged = dict(base)
+    for k, v in override.items():
+      if isinstance(v, dict) and isinstance(merged.get(k), dict):
+        merged[k] = deep_merge(merged[k], v)
+      else:
+        merged[k] = copy.deepcopy(v)
+
+    return merged
+
+def merge_patch(target, patch):
+    """ Applies a JSON merge patch (RFC 7386): nested objects are patched
+    recursively and null values delete keys """
+    if not isinstance(patch, dict):
+      return copy.deepcopy(patch)
+
+    merged = dict(target) if isinstance(target, dict) else {}
+    for k, v in patch.items():
+      if v is None:
+        merged.pop(k, None)
+      else:
+        merged[k] = merge_patch(merged.get(k), v)
+
+    return merged
+
+def merge_attributes(attributes, deep=False):
+    """ Merges attribute dicts, sorted by increasing precedence """
+    attrs = {}
+    for a in attributes:
+      if deep:
+        attrs = deep_merge(attrs, a)
+      else:
+        attrs.update(a)
+
+    return attrs
+
+def profile_attributes(profiles):
+    """ Returns the merged attributes of profiles and their digest. The
+    returned dict is shared and must not be modified """
+    # Hosts usually share a handful of profile combinations: attributes are
+    # parsed and merged once per combination and reused afterwards
+    key = tuple((p.id, p.version) for p in profiles)
+    cache = attributes_cache()
+
+    r = cache.get(key)
+    if r is None:
+      # Load the deferred attributes of all the profiles at once
+      unloaded = [p.id for p in profiles
+                  if '_attributes' in inspect(p).unloaded]
+      if unloaded:
+        db.session.query(Profile).options(undefer('_attributes')).\
+          filter(Profile.id.in_(unloaded)).all()
+
+      attrs = merge_attributes([p.attributes for p in profiles],
+                               current_app.config['BMGR_DEEP_MERGE'])
+      digest = hashlib.sha1(
+        json.dumps(attrs, sort_keys=True).encode('utf-8')).hexdigest()
+      r = (attrs, digest)
+      cache.set(key, r)
 
-    return host
+    return r
 
 def merge_profile_attributes(profiles):
-    # TODO: We should look at deep merging
-    r = {}
-    for p in profiles:
-      r.update(p.attributes)
-
-    return r
+    return dict(profile_attributes(profiles)[0])
 
 class Resource(db.Model):
   __tablename__ = 'resources'
@@ -145,8 +267,8 @@ class Alias(db.Model):
   __table_args__ = (UniqueConstraint('name', 'host_id', name='uix_1'),)
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(255))
-  target_id = db.Column(db.Integer, db.ForeignKey('resources.id'))
-  host_id = db.Column(db.Integer, db.ForeignKey('hosts.id'))
+  target_id = db.Column(db.Integer, db.ForeignKey('resources.id'), index=True)
+  host_id = db.Column(db.Integer, db.ForeignKey('hosts.id'), index=True)
   autodelete = db.Column(db.Boolean)
 
   target = relationship("Resource", uselist=False)
@@ -185,8 +307,13 @@ def init_db():
   db.session.add(boot_alias)
   db.session.add(kickstart)
   db.session.add(poap)
+  init_counters()
   db.session.commit()
 
+  # A new database already has the latest schema
+  from . import migrations
+  migrations.set_version(migrations.latest_version())
+  db.session.commit()
 
 def get_profile(profile_name):
   try:
@@ -196,6 +323,22 @@ def get_profile(profile_name):
 
   return p
 
+def get_profiles(profile_names):
+  """ Returns a list of Profiles from their names with a single query """
+  profiles = {}
+  if profile_names:
+    profiles = dict((p.name, p) for p in db.session.query(Profile).filter(
+      Profile.name.in_(profile_names)))
+
+  r = []
+  for name in profile_names:
+    if name not in profiles:
+      json_abort(404, "Profile '{}' not found".format(name))
+    if profiles[name] not in r:
+      r.append(profiles[name])
+
+  return r
+
 def get_resource(resource_name):
   try:
     r = db.session.query(Resource).filter_by(name=resource_name).one()
@@ -219,26 +362,738 @@ def get_alias(alias_name, hostname=None, allow_fail=False):
     else:
       json_abort(404, "Alias '{}' not found".format(alias_name))
 
-def render(tpl, context):
-  path = parse_template_uri(tpl)
-  return jinja2.Environment(loader = jinja2.FileSystemLoader(
-      current_app.config['BMGR_TEMPLATE_PATH'])).get_template(path).render(
-    context)
+class LRUCache(object):
+  """ Thread-safe mapping which evicts its least recently used entries
+  once the total weight of its values exceeds max_size. Each value weighs 1
+  unless a weigh function is given """
+
+  def __init__(self, max_size, weigh=None):
+    self.max_size = max_size
+    self.weigh = weigh or (lambda value: 1)
+    self.weight = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      try:
+        value = self._entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return None
+
+      self._entries[key] = value
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    weight = self.weigh(value)
+    if weight > self.max_size:
+      return
+
+    with self._lock:
+      self._remove(key)
+      self._entries[key] = value
+      self.weight += weight
+      while self.weight > self.max_size:
+        self._remove(next(iter(self._entries)))
+
+  def _remove(self, key):
+    if key in self._entries:
+      self.weight -= self.weigh(self._entries.pop(key))
+
+  def discard(self, predicate):
+    with self._lock:
+      for key in [k for k in self._entries if predicate(k)]:
+        self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.weight = 0
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries)}
+
+CompiledTemplate = collections.namedtuple('CompiledTemplate',
+                                          ['template', 'version', 'variables',
+                                           'references'])
+
+class TemplateCache(object):
+  """ Compiles templates once and reuses them until their source changes.
+
+  Along with the compiled template, the cache records a version number which
+  changes each time the template is reloaded, the set of variables the
+  template references (None if it includes other templates) and the names of
+  the templates it includes, extends or imports (None if some of them are
+  only known at render time). Sources are parsed once per reload. If
+  bytecode_cache_dir is set, compiled templates are also stored on disk,
+  along with their variables and references, so that other processes do
+  not have to parse them again. """
+
+  def __init__(self, template_path, auto_reload=True, bytecode_cache_dir=None):
+    bytecode_cache = None
+    if bytecode_cache_dir is not None:
+      bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+
+    self.env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path),
+                                  auto_reload=auto_reload,
+                                  bytecode_cache=bytecode_cache)
+    self.auto_reload = auto_reload
+    self.hits = 0
+    self.misses = 0
+    self._version = 0
+    self._templates = {}
+    self._lock = threading.Lock()
+
+  def get(self, name):
+    with self._lock:
+      tpl = self._templates.get(name)
+      if tpl is not None and (not self.auto_reload or
+                              tpl.template.is_up_to_date):
+        self.hits += 1
+        return tpl
+
+      self.misses += 1
+      self._version += 1
+      version = self._version
+
+    template, variables, references = self._load(name)
+    tpl = CompiledTemplate(template, version, variables, references)
+
+    with self._lock:
+      self._templates[name] = tpl
+
+    return tpl
+
+  def _meta_path(self, bucket):
+    bytecode_cache = self.env.bytecode_cache
+    return os.path.join(bytecode_cache.directory,
+                        bytecode_cache.pattern % (bucket.key + '.meta'))
+
+  def _load_meta(self, bucket):
+    """ Returns the variables and references stored along with the bytecode
+    of a bucket, or None if they are missing or outdated """
+    try:
+      with open(self._meta_path(bucket)) as f:
+        m = json.load(f)
+    except (IOError, ValueError):
+      return None
 
-def delete_profile(name):
-  p = get_profile(name)
-  db.session.delete(p)
+    if m.get('checksum') != bucket.checksum:
+      return None
 
-def query_hosts(host_list=None, check_count=False):
-  hosts = db.session.query(Host).options(joinedload('profiles'))
+    variables, references = m['variables'], m['references']
+    return (frozenset(variables) if variables is not None else None,
+            tuple(references) if references is not None else None)
+
+  def _store_meta(self, bucket, variables, references):
+    path = self._meta_path(bucket)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+      json.dump({'checksum': bucket.checksum,
+                 'variables': sorted(variables)
+                              if variables is not None else None,
+                 'references': list(references)
+                               if references is not None else None}, f)
+    os.rename(tmp, path)
+
+  def _load(self, name):
+    """ Returns a template with its variables and references. The source is
+    parsed at most once, and not at all when its bytecode and metadata are
+    found in the bytecode cache """
+    env = self.env
+    source, filename, uptodate = env.loader.get_source(env, name)
+
+    bucket = None
+    code = None
+    if env.bytecode_cache is not None:
+      bucket = env.bytecode_cache.get_bucket(env, name, filename, source)
+      m = self._load_meta(bucket) if bucket.code is not None else None
+      if m is not None:
+        code = bucket.code
+        variables, references = m
+
+    if code is None:
+      ast = env.parse(source, name, filename)
+      references = tuple(meta.find_referenced_templates(ast))
+      if references:
+        variables = None
+      else:
+        variables = frozenset(meta.find_undeclared_variables(ast))
+      if None in references:
+        references = None
+
+      code = env.compile(ast, name, filename)
+      if bucket is not None:
+        bucket.code = code
+        env.bytecode_cache.set_bucket(bucket)
+        self._store_meta(bucket, variables, references)
+
+    template = env.template_class.from_code(env, code, env.make_globals(None),
+                                            uptodate)
+    return template, variables, references
+
+  def versions(self, name, tpl, _parents=()):
+    """ Returns the versions of a compiled template and of the templates it
+    references, reloading the ones which changed, or None if they cannot
+    all be known before rendering """
+    if tpl.references is None:
+      return None
 
-  if host_list is not None:
-      hosts = hosts.filter(Host.hostname.in_(host_list))
-      if check_count and hosts.count() != len(host_list):
-        json_abort(404, "Host not found")
+    versions = (tpl.version,)
+    parents = _parents + (name,)
+    for ref in tpl.references:
+      if ref in parents:
+        continue
+      try:
+        ref_versions = self.versions(ref, self.get(ref), parents)
+      except jinja2.exceptions.TemplateError:
+        # Left for the render to report
+        return None
+      if ref_versions is None:
+        return None
+      versions += ref_versions
+
+    return versions
+
+  def clear(self):
+    with self._lock:
+      self._templates.clear()
+      self.env.cache.clear()
+      if self.env.bytecode_cache is not None:
+        self.env.bytecode_cache.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._templates)}
+
+# Templates compiled by each render pool worker process
+_worker_templates = None
+
+def init_render_worker(template_path, auto_reload, bytecode_cache_dir):
+  global _worker_templates
+  _worker_templates = TemplateCache(template_path, auto_reload,
+                                    bytecode_cache_dir)
+
+def render_template(templates, path, context):
+  """ Returns an (output, error message) tuple """
+  try:
+    return templates.get(path).template.render(context), None
+  except jinja2.exceptions.TemplateError as e:
+    return None, 'Error while rendering template: ' + str(e)
+
+def render_worker(job):
+  return render_template(_worker_templates, *job)
+
+class RenderPool(object):
+  """ Renders (template path, context) jobs in a pool of worker processes,
+  each one compiling templates once in its own template cache. Without
+  processes, for a single job, or if the workers cannot be started,
+  templates are rendered in the calling thread.
+
+  Workers run the Python interpreter given by executable, which defaults to
+  sys.executable. It has to be set when the server is embedded in another
+  program, such as mod_wsgi where sys.executable is httpd. """
+
+  def __init__(self, processes, template_path, auto_reload=True,
+               bytecode_cache_dir=None, executable=None, start_timeout=60):
+    self.processes = processes
+    self.executable = executable or sys.executable
+    self.start_timeout = start_timeout
+    self._initargs = (template_path, auto_reload, bytecode_cache_dir)
+    self._pool = None
+    self._failed = False
+    self._lock = threading.Lock()
+
+  def _start_pool(self):
+    """ Returns a pool whose workers answered a first job """
+    if not self.executable or not os.access(self.executable, os.X_OK):
+      raise OSError('Python interpreter {!r} is not executable'.format(
+        self.executable))
+
+    ctx = multiprocessing.get_context('spawn')
+    ctx.set_executable(self.executable)
+    pool = ctx.Pool(self.processes, initializer=init_render_worker,
+                    initargs=self._initargs)
+    try:
+      # Workers which are not Python interpreters exit without ever
+      # answering, and the pool keeps restarting them
+      pool.apply_async(os.getpid).get(self.start_timeout)
+    except BaseException:
+      pool.terminate()
+      pool.join()
+      raise
+    return pool
+
+  def _get_pool(self):
+    with self._lock:
+      # Workers are started on first use, from a clean interpreter rather
+      # than forked from a threaded server holding database connections
+      if self._pool is None and not self._failed:
+        try:
+          self._pool = self._start_pool()
+        except Exception as e:
+          self._failed = True
+          current_app.logger.error(
+            'Unable to start render worker processes with {!r}, rendering '
+            'in the request threads instead: {}'.format(
+              self.executable, str(e) or type(e).__name__))
+      return self._pool
+
+  def render(self, jobs):
+    pool = None
+    if self.processes and len(jobs) >= 2:
+      pool = self._get_pool()
+
+    if pool is None:
+      return [render_template(templates(), path, context)
+              for path, context in jobs]
+
+    chunksize = max(1, len(jobs) // (self.processes * 4))
+    return pool.map(render_worker, jobs, chunksize)
+
+  def close(self):
+    """ Stops the workers, which are restarted with empty template caches
+    on next use. Starting them is attempted again if it failed """
+    with self._lock:
+      self._failed = False
+      if self._pool is not None:
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+def init_app(app):
+  bytecode_cache_dir = None
+  if app.config['BMGR_TEMPLATE_BYTECODE_CACHE']:
+    bytecode_cache_dir = os.path.join(app.instance_path, 'templates_bytecode')
+    try:
+      os.makedirs(bytecode_cache_dir)
+    except OSError:
+      pass
+
+  app.extensions['bmgr_templates'] = TemplateCache(
+    app.config['BMGR_TEMPLATE_PATH'],
+    app.config['BMGR_TEMPLATE_AUTO_RELOAD'],
+    bytecode_cache_dir)
+  app.extensions['bmgr_attributes'] = LRUCache(
+    app.config['BMGR_ATTRIBUTES_CACHE_SIZE'])
+  app.extensions['bmgr_renders'] = LRUCache(
+    app.config['BMGR_RENDER_CACHE_SIZE'], weigh=lambda r: len(r[0]))
+  app.extensions['bmgr_render_pool'] = RenderPool(
+    app.config['BMGR_RENDER_PROCESSES'],
+    app.config['BMGR_TEMPLATE_PATH'],
+    app.config['BMGR_TEMPLATE_AUTO_RELOAD'],
+    bytecode_cache_dir,
+    app.config['BMGR_RENDER_PYTHON'])
+
+def templates():
+  return current_app.extensions['bmgr_templates']
+
+def attributes_cache():
+  return current_app.extensions['bmgr_attributes']
+
+def render_cache():
+  return current_app.extensions['bmgr_renders']
+
+def render_pool():
+  return current_app.extensions['bmgr_render_pool']
+
+def invalidate_profile(profile):
+  attributes_cache().discard(
+    lambda key: any(pid == profile.id for pid, _ in key))
+  render_cache().discard(lambda key: profile.id in key[2])
+
+def invalidate_resource(resource):
+  path = parse_template_uri(resource.template_uri)
+  render_cache().discard(lambda key: key[0] == path)
+
+# Statements run on every render are built and compiled once
+bakery = baked.bakery()
+
+# Entities of the render resolution query, shared by all the renders
+_override = aliased(Alias)
+_override_target = aliased(Resource)
+_default = aliased(Alias)
+_default_target = aliased(Resource)
+_direct = aliased(Resource)
+
+def resolve_resource(name, hostname):
+  """ Returns the host, the resource to render, the alias which selected it
+  (or None) and the resource to fall back to without host override, in a
+  single query """
+  query = bakery(lambda session: session.query(
+    Host, _override, _override_target, _default, _default_target, _direct).\
+    outerjoin(_override, and_(_override.host_id==Host.id,
+                              _override.name==bindparam('name'))).\
+    outerjoin(_override_target, _override_target.id==_override.target_id).\
+    outerjoin(_default, and_(_default.host_id==None,
+                             _default.name==bindparam('name'))).\
+    outerjoin(_default_target, _default_target.id==_default.target_id).\
+    outerjoin(_direct, _direct.name==bindparam('name')).\
+    options(joinedload(Host.profiles)).\
+    filter(Host.hostname==bindparam('hostname')))
+
+  # Hostnames are unique: unlike first(), all() does not wrap the eagerly
+  # loaded query in a subquery
+  rows = query(db.session()).params(name=name, hostname=hostname).all()
+  if not rows:
+    json_abort(404, "Host '{}' not found".format(hostname))
 
-  return hosts
+  host, o, o_target, d, d_target, resource = rows[0]
+  if d is not None:
+    a, resource = d, d_target
+  else:
+    a = None
+
+  if o is not None:
+    return host, o_target, o, resource
+  if resource is None:
+    json_abort(404, "Resource '{}' not found".format(name))
 
+  return host, resource, a, resource
+
+def consume_override(alias):
+  """ Deletes a oneshot override with a single conditional statement.
+  Returns False if a concurrent request consumed it first """
+  r = db.session.execute(Alias.__table__.delete().where(
+    and_(Alias.id==alias.id, Alias.autodelete==True)))
+  db.session.commit()
+
+  return r.rowcount == 1
+
+def resolve_resources(name, host_list):
+  """ Bulk version of resolve_resource. Returns a list of (hostname,
+  profile ids, resource, oneshot override id or None) tuples and the
+  resource to fall back to without host override. Hosts and overrides are
+  read with one query per chunk of hosts """
+  default = db.session.query(Alias).options(joinedload(Alias.target)).\
+    filter(Alias.name==name, Alias.host_id==None).first()
+  if default is not None:
+    fallback = default.target
+  else:
+    fallback = db.session.query(Resource).filter_by(name=name).first()
+
+  overrides = {}
+  for chunk in chunks(host_list):
+    for hostname, alias_id, autodelete, target in db.session.query(
+        Host.hostname, Alias.id, Alias.autodelete, Resource).\
+        join(Alias, Alias.host_id==Host.id).\
+        join(Resource, Resource.id==Alias.target_id).\
+        filter(Alias.name==name, Host.hostname.in_(chunk)):
+      overrides[hostname] = (target, alias_id if autodelete else None)
+
+  hosts = []
+  for hostname, profile_ids in iter_host_profile_ids(host_list):
+    resource, oneshot = overrides.get(hostname, (fallback, None))
+    if resource is None:
+      json_abort(404, "Resource '{}' not found".format(name))
+    hosts.append((hostname, profile_ids, resource, oneshot))
+
+  if len(hosts) != len(host_list):
+    json_abort(404, "Host not found")
+
+  return hosts, fallback
+
+def consume_overrides(alias_ids):
+  """ Deletes oneshot overrides with one statement per chunk and returns
+  the set of ids actually consumed. When a concurrent request consumed
+  some of a chunk first, the chunk is rolled back and retried one override
+  at a time to find out which ones were lost """
+  table = Alias.__table__
+  consumed = set()
+  for chunk in chunks(alias_ids):
+    r = db.session.execute(table.delete().where(
+      and_(table.c.id.in_(chunk), table.c.autodelete==True)))
+    if r.rowcount == len(chunk):
+      db.session.commit()
+      consumed.update(chunk)
+      continue
+
+    db.session.rollback()
+    for alias_id in chunk:
+      r = db.session.execute(table.delete().where(
+        and_(table.c.id==alias_id, table.c.autodelete==True)))
+      if r.rowcount == 1:
+        consumed.add(alias_id)
+    db.session.commit()
+
+  return consumed
+
+def get_template_or_abort(tpl):
+  try:
+    return templates().get(parse_template_uri(tpl))
+  except jinja2.exceptions.TemplateNotFound as e:
+    json_abort(400, 'Template not found on server: ' + str(e))
+  except jinja2.exceptions.TemplateSyntaxError as e:
+    json_abort(400, 'Error while compiling template: {} (line {})'.format(
+      e.message, e.lineno))
+  except jinja2.exceptions.TemplateError as e:
+    json_abort(400, 'Error while rendering template: ' + str(e))
+
+def render_host_or_abort(tpl, host):
+  try:
+    return render_host(tpl, host)
+  except jinja2.exceptions.TemplateNotFound as e:
+    json_abort(400, 'Template not found on server: ' + str(e))
+  except jinja2.exceptions.TemplateError as e:
+    json_abort(400, 'Error while rendering template: ' + str(e))
+
+def render_host(tpl, host):
+  """ Renders a template for a host and returns the output with its ETag """
+  return render_profiles(tpl, host.hostname, host.profiles)
+
+def render_job(tpl, hostname, profiles):
+  """ Returns the render cache key (None if the output must not be cached),
+  the template path, the compiled template and the context to render a
+  template for a hostname with the attributes of profiles, sorted by merge
+  order """
+  path = parse_template_uri(tpl)
+  compiled = templates().get(path)
+  versions = templates().versions(path, compiled)
+  attributes, digest = profile_attributes(profiles)
+
+  # Outputs which do not depend on the hostname are shared by all the hosts
+  # with the same attributes
+  key_hostname = hostname
+  if compiled.variables is not None and 'hostname' not in compiled.variables:
+    key_hostname = None
+
+  # Outputs of templates whose includes cannot be tracked are not cached
+  key = None
+  if versions is not None:
+    key = (path, versions, tuple(p.id for p in profiles),
+           digest, key_hostname)
+  context = {u'hostname': hostname}
+  context.update(attributes)
+  return key, path, compiled, context
+
+def warn_missing_attributes(path, compiled, context):
+  """ Logs the variables referenced by a template which are neither host
+  attributes nor Jinja globals """
+  if compiled.variables is None:
+    return
+
+  missing = compiled.variables - set(context) - set(templates().env.globals)
+  if missing:
+    current_app.logger.warning(
+      "Template '%s' references undefined attributes for host '%s': %s",
+      path, context['hostname'], ', '.join(sorted(missing)))
+
+def rendered(output):
+  return (output, hashlib.sha1(output.encode('utf-8')).hexdigest())
+
+def render_profiles(tpl, hostname, profiles):
+  """ Renders a template for a hostname with the attributes of profiles,
+  sorted by merge order, and returns the output with its ETag """
+  key, path, compiled, context = render_job(tpl, hostname, profiles)
+  cache = render_cache()
+  r = cache.get(key) if key is not None else None
+  if r is None:
+    warn_missing_attributes(path, compiled, context)
+    r = rendered(compiled.template.render(context))
+    if key is not None:
+      cache.set(key, r)
+
+  return r
+
+# Placeholder render cache key of the outputs which are not cached
+UNCACHED = object()
+
+def render_many(items):
+  """ Renders (template uri, hostname, profiles) items. Returns a list of
+  (output, ETag) tuples, or error messages for the items which failed to
+  render. Outputs missing from the render cache are rendered once, in the
+  render pool if it is enabled """
+  cache = render_cache()
+  results = [None] * len(items)
+  pending = collections.OrderedDict()
+  for i, (tpl, hostname, profiles) in enumerate(items):
+    key, path, compiled, context = render_job(tpl, hostname, profiles)
+    if key is None:
+      # Uncached outputs are rendered for each item
+      key = (UNCACHED, i)
+    elif key in pending:
+      pending[key][2].append(i)
+      continue
+
+    r = cache.get(key)
+    if r is not None:
+      results[i] = r
+    else:
+      warn_missing_attributes(path, compiled, context)
+      pending[key] = (path, context, [i])
+
+  outputs = render_pool().render([(path, context)
+                                  for path, context, _ in pending.values()])
+  for (key, (_, _, indexes)), (output, error) in zip(pending.items(),
+                                                      outputs):
+    if error is None:
+      r = rendered(output)
+      if key[0] is not UNCACHED:
+        cache.set(key, r)
+    else:
+      r = error
+
+    for i in indexes:
+      results[i] = r
+
+  return results
+
+host_pattern = re.compile(r'^(.*?)(\d+)$')
+
+def fold_hostnames(hostnames):
+  """ Returns the nodeset of a list of hostnames. Numeric suffixes are
+  folded into ranges before parsing, which is much faster than
+  NodeSet.fromlist() on large lists """
+  groups = {}
+  others = []
+  for hostname in hostnames:
+    m = host_pattern.match(hostname)
+    if m is None:
+      others.append(hostname)
+      continue
+    prefix, digits = m.groups()
+    # Zero-padded indexes are folded separately for each width
+    width = len(digits) if digits[0] == '0' and len(digits) > 1 else 0
+    groups.setdefault((prefix, width), []).append(int(digits))
+
+  patterns = []
+  for (prefix, width), indexes in groups.items():
+    indexes.sort()
+    ranges = []
+    for _, run in itertools.groupby(enumerate(indexes),
+                                    lambda i: i[1] - i[0]):
+      run = list(run)
+      first, last = run[0][1], run[-1][1]
+      if first == last:
+        ranges.append('{0:0{1}d}'.format(first, width))
+      else:
+        ranges.append('{0:0{2}d}-{1:0{2}d}'.format(first, last, width))
+    patterns.append('{}[{}]'.format(prefix, ','.join(ranges)))
+
+  return nodeset(','.join(patterns + others))
+
+def chunks(iterable, size=CHUNK_SIZE):
+  it = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(it, size))
+    if not chunk:
+      return
+    yield chunk
+
+def init_counters():
+  """ Creates the missing change counters """
+  table = change_counters_table
+  existing = set(n for (n,) in db.session.query(table.c.name))
+  now = datetime.datetime.utcnow()
+  for name in CHANGE_COUNTERS:
+    if name not in existing:
+      db.session.execute(table.insert(), {'name': name, 'counter': 0,
+                                          'modified': now})
+
+def bump_counters(*names):
+  """ Records a change of the named kinds of objects, in the current
+  transaction """
+  table = change_counters_table
+  db.session.execute(table.update().where(table.c.name.in_(names)).values(
+    counter=table.c.counter + 1, modified=datetime.datetime.utcnow()))
+
+def counters_version(names):
+  """ Returns an ETag and the last modification date of the named kinds of
+  objects, or None as date if it is not tracked.
+
+  Renders consume oneshot overrides without bumping the aliases counter, so
+  that they do not all queue on the lock of the same row. Deleting rows
+  changes the number of aliases, which is read in the same query and is
+  part of the ETag instead """
+  table = change_counters_table
+  columns = [table.c.name, table.c.counter, table.c.modified]
+  if 'aliases' in names:
+    columns.append(select([func.count()]).select_from(Alias.__table__).\
+                   as_scalar())
+  rows = db.session.query(*columns).\
+    filter(table.c.name.in_(names)).order_by(table.c.name).all()
+
+  # Dates tell counters apart when a database is recreated
+  etag = hashlib.sha1(json.dumps(
+    [[str(v) for v in row] for row in rows]).encode('utf-8')).hexdigest()
+  modified = max(row[2] for row in rows) if rows else None
+  if 'aliases' in names:
+    modified = None
+  return etag, modified
+
+def conditional(*names):
+  """ Tags responses with an ETag and, unless aliases are involved, a
+  Last-Modified date derived from the change counters of the named kinds of
+  objects. Requests for an unchanged version are answered with 304 Not
+  Modified without running the view """
+  def decorator(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      # Counters are read first: a concurrent change can only make the
+      # response look older than it is
+      etag, modified = counters_version(names)
+
+      # Dates are compared with their full precision: HTTP dates are cut to
+      # whole seconds, which would hide a change made in the same second as
+      # the previous response
+      if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+      else:
+        not_modified = (request.if_modified_since is not None and
+                        modified is not None and
+                        modified <= request.if_modified_since.replace(
+                          tzinfo=None))
+
+      if not_modified:
+        response = current_app.response_class(status=304)
+      else:
+        response = make_response(f(*args, **kwargs))
+        if response.status_code != 200:
+          return response
+
+      response.set_etag(etag)
+      if modified is not None:
+        response.last_modified = modified.replace(microsecond=0)
+      return response
+
+    return wrapper
+
+  return decorator
+
+class Timings(object):
+  """ Measures the duration of the phases of a request and reports them in
+  a Server-Timing header """
+
+  def __init__(self):
+    self.phases = []
+    self._last = time.time()
+
+  def mark(self, phase):
+    now = time.time()
+    self.phases.append((phase, now - self._last))
+    self._last = now
+
+  def apply(self, response):
+    response.headers['Server-Timing'] = ', '.join(
+      '{};dur={:.1f}'.format(phase, duration * 1000)
+      for phase, duration in self.phases)
+    return response
+
+def delete_profile(name):
+  p = get_profile(name)
+  invalidate_profile(p)
+  db.session.delete(p)
 
 def query_aliases(alias_name=None, host_list=None, check_count=False):
   aliases = db.session.query(Alias)
@@ -255,31 +1110,155 @@ def query_aliases(alias_name=None, host_list=None, check_count=False):
 
   return aliases
 
-def get_hosts_folded(host_list=None):
-  hosts = query_hosts(host_list)
-  folded_list = []
-
-  for profiles, group in itertools.groupby(sorted(hosts, key = lambda h: h.profiles),
-                                           lambda x: x.profiles):
-    folded_list.append({
-        'name': str(nodeset.fromlist([h.hostname for h in group])),
-        'profiles': [p.name for p in sorted(profiles)],
-        'attributes': merge_profile_attributes(profiles)})
-
-  return sorted(folded_list, key = lambda g: g['profiles'])
+def parse_where(clauses):
+  """ Parses key=value attribute filters """
+  where = []
+  for clause in clauses:
+    key, sep, value = clause.partition('=')
+    if not sep or not key:
+      json_abort(400, "Invalid attribute filter '{}'".format(clause))
+    where.append((key, value))
+
+  return where
+
+def where_host_filters(where):
+  """ Returns SQL filters selecting the hosts which have, for each key=value
+  clause, at least one profile defining it. Profiles are searched with a JSON
+  path query and hosts are reached through the profile_id index. """
+  filters = []
+  for key, value in where:
+    profile_ids = db.session.query(Profile.id).\
+      filter(Profile._attributes[key].as_string()==value)
+    filters.append(Host.id.in_(
+      select([host_profiles_table.c.host_id]).\
+      where(host_profiles_table.c.profile_id.in_(profile_ids.subquery()))))
+
+  return filters
+
+def match_attributes(attrs, where):
+  return all(attrs.get(key) == value for key, value in where)
+
+def iter_host_profile_ids(host_list=None, filters=()):
+  """ Yields (hostname, profile ids) tuples from a Core statement, without
+  building ORM rows """
+  query = select([Host.hostname, host_profiles_table.c.profile_id]).\
+    select_from(Host.__table__.outerjoin(
+      host_profiles_table, host_profiles_table.c.host_id==Host.id)).\
+    order_by(Host.id).\
+    execution_options(stream_results=True)
+  for f in filters:
+    query = query.where(f)
+
+  if host_list is None:
+    results = [db.session.execute(query)]
+  else:
+    query = query.where(Host.hostname.in_(
+      bindparam('hostnames', expanding=True)))
+    results = (db.session.execute(query, {'hostnames': chunk})
+               for chunk in chunks(host_list))
+
+  for result in results:
+    rows = itertools.chain.from_iterable(
+      iter(lambda: result.fetchmany(CHUNK_SIZE), []))
+    for hostname, rows in itertools.groupby(rows, lambda r: r[0]):
+      yield hostname, tuple(sorted(set(r[1] for r in rows
+                                       if r[1] is not None)))
+
+def load_profiles(profile_ids):
+  """ Returns a dict of profiles by id, loaded with their attributes in a
+  single query """
+  profile_ids = set(profile_ids)
+  if not profile_ids:
+    return {}
+
+  return dict((p.id, p) for p in db.session.query(Profile).\
+              options(undefer('_attributes')).\
+              filter(Profile.id.in_(profile_ids)))
+
+def iter_folded_hosts(host_list=None, where=None):
+  """ Yields groups of hosts sharing the same profiles. All the host rows
+  are scanned and grouped before the first group is yielded, since any host
+  may belong to any group; only the folding of hostnames and the merging of
+  attributes are done lazily, as each group is consumed. If where is set,
+  only the groups whose merged attributes match all the key=value clauses
+  are returned """
+  filters = where_host_filters(where) if where else ()
+  groups = {}
+  for hostname, profile_ids in iter_host_profile_ids(host_list, filters):
+    groups.setdefault(profile_ids, []).append(hostname)
+
+  profiles = load_profiles(itertools.chain.from_iterable(groups))
+
+  folded_groups = []
+  for profile_ids, hostnames in groups.items():
+    group_profiles = sorted((profiles[i] for i in profile_ids),
+                            key=profile_merge_order)
+    # Candidate hosts may have the value overridden by a heavier profile
+    if where and not match_attributes(profile_attributes(group_profiles)[0],
+                                      where):
+      continue
+    folded_groups.append(([p.name for p in sorted(group_profiles)],
+                          group_profiles, hostnames))
+
+  folded_groups.sort(key = lambda g: g[0])
+  for names, group_profiles, hostnames in folded_groups:
+    yield {
+        'name': str(fold_hostnames(hostnames)),
+        'profiles': names,
+        'attributes': merge_profile_attributes(group_profiles)}
+
+def get_hosts_folded(host_list=None, where=None):
+  return list(iter_folded_hosts(host_list, where))
 
 def delete_hosts(host_list):
-  db_hosts = query_hosts(host_list, check_count=True)
-
-  for dbh in db_hosts:
-    db.session.delete(dbh)
-
-def get_host(hostname):
-  """ Returns a single Host """
-  try:
-    return query_hosts([hostname]).one()
-  except NoResultFound:
-    json_abort(404, "Host '{}' not found".format(hostname))
+  """ Deletes hosts with their aliases and profile associations using
+  set-based statements """
+  host_ids = get_host_ids(host_list)
+
+  for chunk in chunks(host_ids):
+    db.session.execute(host_profiles_table.delete().where(
+      host_profiles_table.c.host_id.in_(chunk)))
+    db.session.execute(Alias.__table__.delete().where(
+      Alias.host_id.in_(chunk)))
+    db.session.execute(Host.__table__.delete().where(
+      Host.id.in_(chunk)))
+
+def insert_hosts(host_list, profiles):
+  """ Inserts hosts and their profile associations with set-based
+  statements """
+  for chunk in chunks(host_list):
+    db.session.execute(Host.__table__.insert(),
+                       [{'hostname': h} for h in chunk])
+
+    # The new host ids are not fetched: rows are copied by the database
+    for p in profiles:
+      hosts = select([Host.id, literal(p.id)]).\
+        where(Host.hostname.in_(bindparam('hostnames', expanding=True)))
+      db.session.execute(host_profiles_table.insert().from_select(
+        ['host_id', 'profile_id'], hosts), {'hostnames': chunk})
+
+def get_host_ids(host_list):
+  """ Returns the ids of hosts from their names, all of them must exist """
+  host_ids = []
+  for chunk in chunks(host_list):
+    host_ids.extend(host_id for (host_id,) in
+                    db.session.query(Host.id).filter(Host.hostname.in_(chunk)))
+
+  if len(host_ids) != len(host_list):
+    json_abort(404, "Host not found")
+
+  return host_ids
+
+def set_hosts_profiles(host_ids, profiles):
+  """ Replaces the profiles of hosts with set-based statements """
+  for chunk in chunks(host_ids):
+    db.session.execute(host_profiles_table.delete().where(
+      host_profiles_table.c.host_id.in_(chunk)))
+
+    if profiles:
+      db.session.execute(host_profiles_table.insert(),
+                         [{'host_id': host_id, 'profile_id': p.id}
+                          for host_id in chunk for p in profiles])
 
 @bp.route('/api/v1.0/hosts', methods=['POST'])
 @expects_json({
@@ -291,37 +1270,42 @@ def get_host(hostname):
   'required': ['name']
 })
 def api_hosts_post():
-  db_hosts = []
-  t0 = time.time()
-  try:
-    host_list = nodeset(g.data['name'])
-    if len(host_list) > MAX_NODESET:
-      json_abort(413, "Nodeset too large")
-
-    for i, host in enumerate(host_list):
-      single_host = g.data
-      single_host['name'] = host
-      db_host = Host.from_dict(single_host)
-      db.session.add(db_host)
-      if i%1000 == 0:
-        db.session.flush()
+  timings = Timings()
+  host_list = nodeset(g.data['name'])
+  if len(host_list) > MAX_NODESET:
+    json_abort(413, "Nodeset too large")
 
-    db.session.commit()
+  profiles = get_profiles(g.data.get('profiles', []))
+  timings.mark('profiles')
+
+  try:
+    insert_hosts(host_list, profiles)
+    bump_counters('hosts')
+    timings.mark('insert')
+    commit()
+    timings.mark('commit')
   except SQLAlchemyError:
     # FIXME: Discriminate errors
     json_abort(409, "Host already exists")
 
   folded_hosts = get_hosts_folded(host_list)
-  return jsonify(folded_hosts)
+  timings.mark('fold')
+  return timings.apply(jsonify(folded_hosts))
 
 @bp.route('/api/v1.0/hosts', methods=['GET'])
+@conditional('hosts', 'profiles')
 def api_hosts_get():
-  return jsonify(get_hosts_folded())
+  where = parse_where(request.args.getlist('where'))
+  if wants_ndjson():
+    return ndjson_response(iter_folded_hosts(where=where))
+
+  return jsonify(get_hosts_folded(where=where))
 
 @bp.route('/api/v1.0/hosts/<string:hostname>', methods=['DELETE'])
 def api_hosts_hostname_delete(hostname):
   delete_hosts(nodeset(hostname))
-  db.session.commit()
+  bump_counters('hosts', 'aliases')
+  commit()
   return make_response(jsonify([]), 204)
 
 @bp.route('/api/v1.0/hosts/<string:hostname>', methods=['PATCH'])
@@ -332,27 +1316,36 @@ def api_hosts_hostname_delete(hostname):
   },
 })
 def api_hosts_hostname_patch(hostname):
-  need_commit = False
+  timings = Timings()
   nodelist=nodeset(hostname)
-  hosts = query_hosts(nodelist, check_count=True)
-  profiles = []
-
-  if 'profiles' in g.data:
-    for p in g.data['profiles']:
-      profiles.append(get_profile(p))
+  host_ids = get_host_ids(nodelist)
+  timings.mark('hosts')
 
-    for host in hosts:
-      host.profiles = profiles
+  if 'profiles' not in g.data:
+    return jsonify(get_hosts_folded(nodelist))
 
-    need_commit = True
+  profiles = get_profiles(g.data['profiles'])
+  timings.mark('profiles')
 
-  if need_commit:
-    db.session.commit()
+  set_hosts_profiles(host_ids, profiles)
+  bump_counters('hosts')
+  timings.mark('update')
+  commit()
+  timings.mark('commit')
 
-  return jsonify(get_hosts_folded(nodelist))
+  # All the updated hosts now share the same profiles
+  profiles.sort(key=profile_merge_order)
+  return timings.apply(jsonify([{
+    'name': str(nodelist),
+    'profiles': [p.name for p in sorted(profiles)],
+    'attributes': merge_profile_attributes(profiles)}]))
 
 @bp.route('/api/v1.0/hosts/<string:hostname>', methods=['GET'])
+@conditional('hosts', 'profiles')
 def api_hosts_hostname_get(hostname):
+  if wants_ndjson():
+    return ndjson_response(iter_folded_hosts(nodeset(hostname)))
+
   return jsonify(get_hosts_folded(nodeset(hostname)))
 
 @bp.route('/api/v1.0/profiles', methods=['POST'])
@@ -369,7 +1362,8 @@ def api_profiles_post():
   try:
     profile = Profile.from_dict(g.data)
     db.session.add(profile)
-    db.session.commit()
+    bump_counters('profiles')
+    commit()
   #FIXME: discriminate errors
   except SQLAlchemyError:
     json_abort(409, "Profile already exists")
@@ -377,8 +1371,9 @@ def api_profiles_post():
   return jsonify(profile.to_dict())
 
 @bp.route('/api/v1.0/profiles', methods=['GET'])
+@conditional('profiles')
 def api_profiles_get():
-  profiles = db.session.query(Profile).all()
+  profiles = db.session.query(Profile).options(undefer('_attributes')).all()
   r = []
   for p in profiles:
     r.append(p.to_dict())
@@ -389,14 +1384,23 @@ def api_profiles_get():
 @bp.route('/api/v1.0/profiles/<string:name>', methods=['DELETE'])
 def api_profiles_profile_delete(name):
   delete_profile(name)
-  db.session.commit()
+  bump_counters('profiles')
+  commit()
   return make_response(jsonify({}), 204)
 
 
 @bp.route('/api/v1.0/profiles/<string:name>', methods=['GET'])
 def api_profiles_profile_get(name):
   profile = get_profile(name)
-  return jsonify(profile.to_dict())
+  # The deferred attributes are only loaded when the client copy is stale
+  if request.if_none_match.contains(profile.version):
+    response = make_response('', 304)
+    response.set_etag(profile.version)
+    return response
+
+  response = jsonify(profile.to_dict())
+  response.set_etag(profile.version)
+  return response
 
 @bp.route('/api/v1.0/profiles/<string:name>', methods=['PATCH'])
 @expects_json({
@@ -407,23 +1411,53 @@ def api_profiles_profile_get(name):
   },
 })
 def api_profiles_profile_patch(name):
-  need_commit = False
-  profile = get_profile(name)
-
-  if 'attributes' in g.data:
-    profile.attributes = g.data['attributes']
-    need_commit = True
-
-  if 'weight' in g.data:
-    profile.weight = g.data['weight']
-    need_commit = True
-
-  if need_commit:
-    db.session.commit()
+  """ With the application/merge-patch+json content type, attributes are
+  patched key by key instead of replaced. The update only applies to the
+  version of the profile given in If-Match, if any. Otherwise, it is
+  retried when a concurrent update of the profile commits first """
+  merge = request.mimetype == 'application/merge-patch+json'
+
+  for attempt in range(UPDATE_RETRIES):
+    profile = get_profile(name)
+    if request.if_match and not request.if_match.contains(profile.version):
+      json_abort(412, "Profile '{}' was modified".format(name))
+
+    need_commit = False
+    if 'attributes' in g.data:
+      attributes = g.data['attributes']
+      if merge:
+        attributes = merge_patch(profile.attributes, attributes)
+      profile.attributes = attributes
+      need_commit = True
+
+    if 'weight' in g.data:
+      profile.weight = g.data['weight']
+      need_commit = True
+
+    if not need_commit:
+      break
+
+    invalidate_profile(profile)
+    bump_counters('profiles')
+    try:
+      commit()
+      break
+    except StaleDataError:
+      db.session.rollback()
+      if request.if_match:
+        json_abort(412, "Profile '{}' was modified".format(name))
+      # The rollback also discarded the previous operations of the batch
+      if in_batch():
+        json_abort(409, "Profile '{}' is being modified".format(name))
+  else:
+    json_abort(409, "Profile '{}' is being modified".format(name))
 
-  return make_response(jsonify(profile.to_dict()), 200)
+  response = make_response(jsonify(profile.to_dict()), 200)
+  response.set_etag(profile.version)
+  return response
 
 @bp.route('/api/v1.0/resources', methods=['GET'])
+@conditional('resources')
 def api_resources_get():
   resources = db.session.query(Resource).all()
   result = []
@@ -442,10 +1476,14 @@ def api_resources_get():
   'required': ['name', 'template_uri']
 })
 def api_resources_post():
+  # Templates are compiled ahead of the first render
+  get_template_or_abort(g.data['template_uri'])
+
   try:
     resource = Resource.from_dict(g.data)
     db.session.add(resource)
-    db.session.commit()
+    bump_counters('resources')
+    commit()
   #FIXME: discriminate errors
   except SQLAlchemyError:
     json_abort(409, "Resource already exists")
@@ -464,48 +1502,124 @@ def api_resources_resource_patch(name):
   resource = get_resource(name)
 
   if 'template_uri' in g.data:
+    get_template_or_abort(g.data['template_uri'])
+    invalidate_resource(resource)
     resource.template_uri = g.data['template_uri']
     need_commit = True
 
   if need_commit:
-    db.session.commit()
+    bump_counters('resources')
+    commit()
 
   return make_response(jsonify(resource.to_dict()), 200)
 
 @bp.route('/api/v1.0/resources/<string:name>', methods=['GET'])
+@conditional('resources')
 def api_resources_resource_get(name):
   return jsonify(get_resource(name).to_dict())
 
 @bp.route('/api/v1.0/resources/<string:name>', methods=['DELETE'])
 def api_resources_resource_delete(name):
   resource = get_resource(name)
+  invalidate_resource(resource)
   db.session.delete(resource)
-  db.session.commit()
+  bump_counters('resources')
+  commit()
   return make_response(jsonify({}), 204)
 
 @bp.route('/api/v1.0/resources/<string:name>/<string:hostname>', methods=['GET'])
 def api_resources_resource_render(name, hostname):
-  a = get_alias(name, hostname, allow_fail=True)
-  if not a:
-    a = get_alias(name, allow_fail=True)
+  host, resource, a, fallback = resolve_resource(name, hostname)
+  output, etag = render_host_or_abort(resource.template_uri, host)
 
-  if a:
-    resource = a.target
-  else:
-    resource = get_resource(name)
+  if a and a.autodelete and not consume_override(a):
+    # Oneshot overrides are only served once, even to concurrent requests
+    if fallback is None:
+      json_abort(404, "Resource '{}' not found".format(name))
+    output, etag = render_host_or_abort(fallback.template_uri, host)
 
-  if a and a.autodelete:
-    db.session.delete(a)
-    db.session.commit()
-
-  host = get_host(hostname)
+  response = make_response(output)
+  response.set_etag(etag)
+  return response.make_conditional(request)
 
-  try:
-    return make_response(render(resource.template_uri, host.attributes))
-  except jinja2.exceptions.TemplateNotFound as e:
-    json_abort(400, 'Template not found on server: ' + str(e))
-  except jinja2.exceptions.TemplateError as e:
-    json_abort(400, 'Error while rendering template: ' + str(e))
+@bp.route('/api/v1.0/resources/<string:name>/render', methods=['POST'])
+@expects_json({
+  'type': 'object',
+  'properties': {
+    'hosts': {'type': 'string'},
+    'dry_run': {'type': 'boolean'},
+  },
+  'required': ['hosts']
+})
+def api_resources_resource_render_batch(name):
+  timings = Timings()
+  host_list = nodeset(g.data['hosts'])
+  if len(host_list) > MAX_NODESET:
+    json_abort(413, "Nodeset too large")
+
+  hosts, fallback = resolve_resources(name, host_list)
+  timings.mark('resolve')
+
+  # Broken templates are reported before any oneshot override is consumed
+  for tpl in set(h[2].template_uri for h in hosts):
+    get_template_or_abort(tpl)
+
+  # Consuming overrides commits and expires the resources and profiles
+  hosts = [(hostname, profile_ids, (r.name, r.template_uri), oneshot)
+           for hostname, profile_ids, r, oneshot in hosts]
+  if fallback is not None:
+    fallback = (fallback.name, fallback.template_uri)
+
+  def render_hosts(hosts, profiles):
+    return render_many([(tpl, hostname,
+                         sorted((profiles[i] for i in profile_ids),
+                                key=profile_merge_order))
+                        for hostname, profile_ids, (_, tpl), _ in hosts])
+
+  # As for a single host, oneshot overrides are rendered first and only the
+  # ones which rendered are consumed: the others are left in place
+  results = {}
+  oneshots = [i for i, h in enumerate(hosts) if h[3] is not None]
+  if oneshots and not g.data.get('dry_run', False):
+    renders = render_hosts([hosts[i] for i in oneshots],
+                           load_profiles(itertools.chain.from_iterable(
+                             hosts[i][1] for i in oneshots)))
+    results = dict(zip(oneshots, renders))
+    rendered_ids = [hosts[i][3] for i in oneshots
+                    if isinstance(results[i], tuple)]
+    consumed = consume_overrides(rendered_ids) if rendered_ids else set()
+    if len(consumed) != len(rendered_ids) and fallback is None:
+      json_abort(404, "Resource '{}' not found".format(name))
+
+    # Oneshot overrides are only served once, even to concurrent requests:
+    # the hosts which lost the race are rendered with the fallback
+    for i in oneshots:
+      hostname, profile_ids, _, oneshot = hosts[i]
+      if isinstance(results[i], tuple) and oneshot not in consumed:
+        hosts[i] = (hostname, profile_ids, fallback, None)
+        del results[i]
+  timings.mark('consume')
+
+  profiles = load_profiles(itertools.chain.from_iterable(
+    h[1] for i, h in enumerate(hosts) if i not in results))
+  timings.mark('profiles')
+
+  def generate():
+    for indexes in chunks(range(len(hosts))):
+      pending = [i for i in indexes if i not in results]
+      results.update(zip(pending, render_hosts([hosts[i] for i in pending],
+                                               profiles)))
+      for i in indexes:
+        hostname, _, (resource, _), _ = hosts[i]
+        r = results.pop(i)
+        item = {'name': hostname, 'resource': resource}
+        if isinstance(r, tuple):
+          item['output'] = r[0]
+        else:
+          item['error'] = r
+        yield item
+
+  return timings.apply(ndjson_response(generate()))
 
 
 @bp.route('/api/v1.0/aliases', methods=['POST'])
@@ -527,7 +1641,8 @@ def api_aliases_post():
   a = Alias(g.data['name'], target, None)
 
   db.session.add(a)
-  db.session.commit()
+  bump_counters('aliases')
+  commit()
 
   #TODO
   return jsonify({})
@@ -543,29 +1658,26 @@ def api_aliases_post():
   'required': ['hosts', 'target']
 })
 def api_aliases_alias_post(name):
-  exists = query_aliases(name)
-
   # Check if the main alias is defined
   main_alias = get_alias(name)
+  target = get_resource(g.data['target'])
+  host_list = nodeset(g.data['hosts'])
 
-  if query_aliases(name, nodeset(g.data['hosts'])).count() > 0:
+  try:
+    created = insert_overrides(name, target, host_list,
+                               g.data.get('autodelete', False))
+  except SQLAlchemyError:
+    db.session.rollback()
     json_abort(409, "Alias or override already exists")
 
-  target = get_resource(g.data['target'])
-  for i,host in enumerate(query_hosts(nodeset(g.data['hosts']),
-                                      check_count=True).all()):
-    a = Alias(name,
-              target,
-              host,
-              g.data.get('autodelete', False))
+  if created != len(host_list):
+    db.session.rollback()
+    json_abort(404, "Host not found")
 
-    db.session.add(a)
-    if i%1000 == 0:
-      db.session.flush()
+  bump_counters('aliases')
+  commit()
 
-  db.session.commit()
-
-  return jsonify({})
+  return jsonify({'created': created})
 
 @bp.route('/api/v1.0/aliases/<string:name>', methods=['DELETE'])
 def api_aliases_alias_delete(name):
@@ -573,7 +1685,8 @@ def api_aliases_alias_delete(name):
   for a in query_aliases(name).all():
     db.session.delete(a)
 
-  db.session.commit()
+  bump_counters('aliases')
+  commit()
   return make_response(jsonify({}), 204)
 
 @bp.route('/api/v1.0/aliases/<string:name>/<string:hostname>', methods=['DELETE'])
@@ -583,46 +1696,80 @@ def api_aliases_alias_host_delete(name, hostname):
                          check_count=True).all():
     db.session.delete(a)
 
-  db.session.commit()
+  bump_counters('aliases')
+  commit()
   return make_response(jsonify({}), 204)
 
+def merge_overrides(overrides):
+  """ Groups hosts with the same overrides """
+  groups = {}
+  for hostname, status in overrides.items():
+    groups.setdefault((status['target'], status['autodelete']),
+                      []).append(hostname)
+
+  return dict((str(fold_hostnames(hostnames)),
+               {'target': target, 'autodelete': autodelete})
+              for (target, autodelete), hostnames in groups.items())
+
+def iter_aliases(name=None, merge=True):
+  """ Yields aliases with their overrides, one alias at a time. Aliases are
+  read with a single joined column query """
+  rows = db.session.query(Alias.name, Host.hostname, Resource.name,
+                          Alias.autodelete).\
+    outerjoin(Host, Alias.host_id==Host.id).\
+    join(Resource, Alias.target_id==Resource.id).\
+    order_by(Alias.name)
+
+  if name is not None:
+    rows = rows.filter(Alias.name==name)
+
+  for alias_name, alias_rows in itertools.groupby(rows.yield_per(CHUNK_SIZE),
+                                                  lambda r: r[0]):
+    r = {'name': alias_name,
+         'target': None,
+         'overrides': {}}
+
+    for _, hostname, target, autodelete in alias_rows:
+      if hostname is not None:
+        r['overrides'][hostname] = {'target': target,
+                                    'autodelete': autodelete}
+      else:
+        r['target'] = target
+
+    if merge:
+      r['overrides'] = merge_overrides(r['overrides'])
+
+    yield r
+
+def insert_overrides(name, target, host_list, autodelete):
+  """ Overrides an alias for hosts with INSERT ... SELECT statements and
+  returns the number of overrides created. Existing overrides are detected
+  by the unique constraint on aliases """
+  created = 0
+  for chunk in chunks(host_list):
+    hosts = select([literal(name), literal(target.id), Host.id,
+                    literal(autodelete, db.Boolean)]).\
+      where(Host.hostname.in_(chunk))
+    r = db.session.execute(Alias.__table__.insert().from_select(
+      ['name', 'target_id', 'host_id', 'autodelete'], hosts))
+    created += r.rowcount
+
+  return created
+
 def alias_to_dict(name=None, merge=True):
-  r = {}
-  for a in query_aliases(name).all():
-    r.setdefault(a.name, {'name': a.name,
-                          'overrides': {} })
-    if a.host:
-      r[a.name]['overrides'][a.host.hostname] = {'target': a.target.name,
-                                                 'autodelete': a.autodelete}
-    else:
-      r[a.name]['target'] = a.target.name
-
-  if merge:
-    merged_res = {}
-    for a in r.keys():
-      merged_overrides = {}
-
-      #Group hosts with the same overrides
-      sorted_overrides = sorted(r[a]['overrides'].items(),
-                                key=lambda x: (x[1]['target'],
-                                               x[1]['autodelete']))
-
-      for status, group in itertools.groupby(sorted_overrides,
-                                              lambda x: x[1]):
-        merged_overrides[str(nodeset.fromlist([h[0] for h in group]))] = status
-
-      merged_res[a] = { 'name': a,
-                        'target': r[a]['target'],
-                        'overrides':  merged_overrides }
-    r = merged_res
-  return r
+  return dict((a['name'], a) for a in iter_aliases(name, merge))
 
 @bp.route('/api/v1.0/aliases', methods=['GET'])
+@conditional('aliases', 'hosts', 'resources')
 def api_aliases_get():
+  if wants_ndjson():
+    return ndjson_response(iter_aliases())
+
   r = alias_to_dict()
   return jsonify(list(r.values()))
 
 @bp.route('/api/v1.0/aliases/<string:name>', methods=['GET'])
+@conditional('aliases', 'hosts', 'resources')
 def api_aliases_alias_get(name):
   alias = list(alias_to_dict(name).values())
   if alias:
@@ -630,6 +1777,406 @@ def api_aliases_alias_get(name):
   else:
     json_abort(404, "Alias not found")
 
+INVENTORY_KINDS = ('resources', 'profiles', 'hosts', 'aliases', 'overrides')
+
+def json_document_response(sections):
+  """ Streams a JSON object whose values are lists, from (key, items)
+  tuples """
+  def generate():
+    for i, (key, items) in enumerate(sections):
+      yield '{}{}: ['.format('{' if i == 0 else '], ', json.dumps(key))
+      for j, item in enumerate(items):
+        yield (', ' if j else '') + json.dumps(item)
+    yield ']}' if sections else '{}'
+
+  return current_app.response_class(stream_with_context(generate()),
+                                    mimetype='application/json')
+
+def iter_export_hosts():
+  for h in iter_folded_hosts():
+    yield {'name': h['name'], 'profiles': h['profiles']}
+
+def iter_export_profiles():
+  profiles = db.session.query(Profile).options(undefer('_attributes')).\
+    order_by(Profile.name)
+  for p in profiles.yield_per(CHUNK_SIZE):
+    yield p.to_dict()
+
+def iter_export_resources():
+  for r in db.session.query(Resource).order_by(Resource.name):
+    yield r.to_dict()
+
+def expand_nodeset(name):
+  host_list = nodeset(name)
+  if len(host_list) > MAX_NODESET:
+    json_abort(413, "Nodeset too large")
+
+  return host_list
+
+def add_unique(items, key, value, kind):
+  if key in items:
+    json_abort(400, "Duplicate {} '{}'".format(kind, key))
+  items[key] = value
+
+def parse_inventory(inventory):
+  """ Returns the objects of an inventory document by kind, in the same
+  form as read_inventory(). References between objects are checked """
+  r = dict((kind, {}) for kind in INVENTORY_KINDS)
+
+  for res in inventory['resources']:
+    parse_template_uri(res['template_uri'])
+    add_unique(r['resources'], res['name'], res['template_uri'], 'resource')
+
+  for p in inventory['profiles']:
+    add_unique(r['profiles'], p['name'],
+               (p.get('attributes', {}), p.get('weight', 0)), 'profile')
+
+  for h in inventory['hosts']:
+    profiles = tuple(sorted(set(h.get('profiles', []))))
+    for name in profiles:
+      if name not in r['profiles']:
+        json_abort(400, "Profile '{}' not found".format(name))
+    for hostname in expand_nodeset(h['name']):
+      add_unique(r['hosts'], hostname, profiles, 'host')
+
+  for a in inventory['aliases']:
+    for target in [a['target']] + [o['target'] for o in
+                                   a.get('overrides', {}).values()]:
+      if target not in r['resources']:
+        json_abort(400, "Resource '{}' not found".format(target))
+
+    add_unique(r['aliases'], a['name'], a['target'], 'alias')
+    for hosts, o in a.get('overrides', {}).items():
+      for hostname in expand_nodeset(hosts):
+        if hostname not in r['hosts']:
+          json_abort(400, "Host '{}' not found".format(hostname))
+        add_unique(r['overrides'], (a['name'], hostname),
+                   (o['target'], o.get('autodelete', False)), 'override')
+
+  return r
+
+def read_inventory():
+  """ Returns all the objects of the database by kind, as dicts of
+  comparable values read with column queries """
+  r = dict((kind, {}) for kind in INVENTORY_KINDS)
+
+  r['resources'] = dict(db.session.query(Resource.name,
+                                         Resource.template_uri))
+
+  for p in iter_export_profiles():
+    r['profiles'][p['name']] = (p['attributes'], p['weight'])
+  names = dict(db.session.query(Profile.id, Profile.name))
+
+  for hostname, profile_ids in iter_host_profile_ids():
+    r['hosts'][hostname] = tuple(sorted(names[i] for i in profile_ids))
+
+  for a in iter_aliases(merge=False):
+    r['aliases'][a['name']] = a['target']
+    for hostname, o in a['overrides'].items():
+      r['overrides'][(a['name'], hostname)] = (o['target'], o['autodelete'])
+
+  return r
+
+def diff_inventory(current, desired):
+  """ Returns the added, updated and deleted keys of each kind of object """
+  diff = {}
+  for kind in INVENTORY_KINDS:
+    cur, new = current[kind], desired[kind]
+    diff[kind] = ([k for k in new if k not in cur],
+                  [k for k in new if k in cur and cur[k] != new[k]],
+                  [k for k in cur if k not in new])
+
+  return diff
+
+def group_by_value(keys, values):
+  groups = {}
+  for k in keys:
+    groups.setdefault(values[k], []).append(k)
+
+  return groups
+
+def execute_chunks(statement, params):
+  for chunk in chunks(params):
+    db.session.execute(statement, chunk)
+
+def apply_inventory(desired, diff):
+  """ Applies the difference with the database with set-based statements,
+  in an order compatible with the foreign keys """
+  resources_table = Resource.__table__
+  profiles_table = Profile.__table__
+  aliases_table = Alias.__table__
+
+  added, updated, deleted = diff['resources']
+  execute_chunks(resources_table.insert(),
+                 [{'name': name, 'template_uri': desired['resources'][name]}
+                  for name in added])
+  execute_chunks(resources_table.update().\
+                 where(resources_table.c.name==bindparam('b_name')).\
+                 values(template_uri=bindparam('b_template_uri')),
+                 [{'b_name': name,
+                   'b_template_uri': desired['resources'][name]}
+                  for name in updated])
+
+  added, updated, deleted = diff['profiles']
+  execute_chunks(profiles_table.insert(),
+                 [{'name': name, 'attributes': desired['profiles'][name][0],
+                   'weight': desired['profiles'][name][1],
+                   'version': new_version()} for name in added])
+  execute_chunks(profiles_table.update().\
+                 where(profiles_table.c.name==bindparam('b_name')).\
+                 values(attributes=bindparam('b_attributes'),
+                        weight=bindparam('b_weight'),
+                        version=bindparam('b_version')),
+                 [{'b_name': name,
+                   'b_attributes': desired['profiles'][name][0],
+                   'b_weight': desired['profiles'][name][1],
+                   'b_version': new_version()} for name in updated])
+
+  profiles = dict((p.name, p) for p in db.session.query(Profile))
+  added, updated, deleted = diff['hosts']
+  delete_hosts(deleted)
+  for names, hostnames in group_by_value(added, desired['hosts']).items():
+    insert_hosts(hostnames, [profiles[n] for n in names])
+  for names, hostnames in group_by_value(updated, desired['hosts']).items():
+    set_hosts_profiles(get_host_ids(hostnames), [profiles[n] for n in names])
+
+  deleted_profiles = [profiles[name].id for name in diff['profiles'][2]]
+  for chunk in chunks(deleted_profiles):
+    db.session.execute(host_profiles_table.delete().where(
+      host_profiles_table.c.profile_id.in_(chunk)))
+    db.session.execute(profiles_table.delete().where(
+      profiles_table.c.id.in_(chunk)))
+
+  resources = dict((r.name, r) for r in db.session.query(Resource))
+  added, updated, deleted = diff['aliases']
+  for chunk in chunks(deleted):
+    db.session.execute(aliases_table.delete().where(
+      aliases_table.c.name.in_(chunk)))
+  execute_chunks(aliases_table.insert(),
+                 [{'name': name, 'host_id': None, 'autodelete': False,
+                   'target_id': resources[desired['aliases'][name]].id}
+                  for name in added])
+  execute_chunks(aliases_table.update().\
+                 where(and_(aliases_table.c.name==bindparam('b_name'),
+                            aliases_table.c.host_id==None)).\
+                 values(target_id=bindparam('b_target_id')),
+                 [{'b_name': name,
+                   'b_target_id': resources[desired['aliases'][name]].id}
+                  for name in updated])
+
+  # Updated overrides are replaced
+  added, updated, deleted = diff['overrides']
+  removed = {}
+  for name, hostname in deleted + updated:
+    removed.setdefault(name, []).append(hostname)
+  for name, hostnames in removed.items():
+    for chunk in chunks(hostnames):
+      db.session.execute(aliases_table.delete().where(and_(
+        aliases_table.c.name==name,
+        aliases_table.c.host_id.in_(select([Host.id]).\
+                                    where(Host.hostname.in_(chunk))))))
+
+  inserted = {}
+  for name, hostname in added + updated:
+    target, autodelete = desired['overrides'][(name, hostname)]
+    inserted.setdefault((name, target, autodelete), []).append(hostname)
+  for (name, target, autodelete), hostnames in inserted.items():
+    insert_overrides(name, resources[target], hostnames, autodelete)
+
+  for chunk in chunks(diff['resources'][2]):
+    db.session.execute(resources_table.delete().where(
+      resources_table.c.name.in_(chunk)))
+
+@bp.route('/api/v1.0/inventory', methods=['GET'])
+@conditional(*CHANGE_COUNTERS)
+def api_inventory_get():
+  return json_document_response([
+    ('profiles', iter_export_profiles()),
+    ('resources', iter_export_resources()),
+    ('hosts', iter_export_hosts()),
+    ('aliases', iter_aliases())])
+
+@bp.route('/api/v1.0/inventory', methods=['PUT'])
+@expects_json({
+  'type': 'object',
+  'properties': {
+    'profiles': {
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'name': {'type': 'string'},
+          'attributes': {'type': 'object'},
+          'weight': {'type': 'integer'},
+        },
+        'required': ['name']
+      }
+    },
+    'resources': {
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'name': {'type': 'string'},
+          'template_uri': {'type': 'string'},
+        },
+        'required': ['name', 'template_uri']
+      }
+    },
+    'hosts': {
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'name': {'type': 'string'},
+          'profiles': {'type': 'array', 'items': {'type': 'string'}},
+        },
+        'required': ['name']
+      }
+    },
+    'aliases': {
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'name': {'type': 'string'},
+          'target': {'type': 'string'},
+          'overrides': {
+            'type': 'object',
+            'additionalProperties': {
+              'type': 'object',
+              'properties': {
+                'target': {'type': 'string'},
+                'autodelete': {'type': 'boolean'},
+              },
+              'required': ['target']
+            }
+          },
+        },
+        'required': ['name', 'target']
+      }
+    },
+  },
+  'required': ['profiles', 'resources', 'hosts', 'aliases']
+})
+def api_inventory_put():
+  """ Replaces the whole inventory with the given document. Only the
+  differences with the database are written """
+  dry_run = request.args.get('dry_run', '').lower() in ('1', 'true')
+  timings = Timings()
+  desired = parse_inventory(g.data)
+  timings.mark('parse')
+  current = read_inventory()
+  timings.mark('read')
+  diff = diff_inventory(current, desired)
+  added, updated, _ = diff['resources']
+  for name in added + updated:
+    get_template_or_abort(desired['resources'][name])
+  timings.mark('diff')
+
+  if not dry_run:
+    apply_inventory(desired, diff)
+    bump_counters(*CHANGE_COUNTERS)
+    timings.mark('apply')
+    db.session.commit()
+    timings.mark('commit')
+    attributes_cache().discard(lambda key: True)
+    render_cache().discard(lambda key: True)
+
+  return timings.apply(jsonify(dict(
+    (kind, {'added': len(added), 'updated': len(updated),
+            'deleted': len(deleted)})
+    for kind, (added, updated, deleted) in diff.items())))
+
+@bp.route('/api/v1.0/cache', methods=['GET'])
+def api_cache_get():
+  return jsonify({'templates': templates().stats(),
+                  'attributes': attributes_cache().stats(),
+                  'renders': render_cache().stats()})
+
+@bp.route('/api/v1.0/cache', methods=['DELETE'])
+def api_cache_delete():
+  templates().clear()
+  attributes_cache().clear()
+  render_cache().clear()
+  render_pool().close()
+  return make_response(jsonify({}), 204)
+
+def run_operation(operation):
+  """ Dispatches an operation of a batch like a request to the same
+  route, with the same headers, in the transaction of the batch """
+  with current_app.test_request_context(operation['path'],
+                                        base_url=request.url_root,
+                                        method=operation['method'],
+                                        headers=operation.get('headers'),
+                                        json=operation.get('body')):
+    if request.url_rule is not None and \
+       request.url_rule.endpoint in BATCH_EXCLUDED:
+      return make_response(jsonify(error='Operation not allowed in a batch'),
+                           400)
+
+    return current_app.full_dispatch_request()
+
+@bp.route('/api/v1.0/batch', methods=['POST'])
+@expects_json({
+  'type': 'object',
+  'properties': {
+    'operations': {
+      'type': 'array',
+      'items': {
+        'type': 'object',
+        'properties': {
+          'method': {'enum': ['POST', 'PATCH', 'DELETE']},
+          'path': {'type': 'string'},
+          'body': {'type': 'object'},
+          'headers': {
+            'type': 'object',
+            'properties': {
+              'Content-Type': {'type': 'string'},
+              'If-Match': {'type': 'string'},
+            },
+            'additionalProperties': False,
+          },
+        },
+        'additionalProperties': False,
+        'required': ['method', 'path']
+      }
+    },
+  },
+  'required': ['operations']
+})
+def api_batch_post():
+  operations = g.data['operations']
+  if len(operations) > MAX_BATCH:
+    json_abort(413, "Batch too large")
+
+  timings = Timings()
+  results = []
+  g.batch = True
+  try:
+    for index, operation in enumerate(operations):
+      response = run_operation(operation)
+      body = response.get_json(silent=True)
+      if response.status_code >= 400:
+        db.session.rollback()
+        error = (body or {}).get('error', response.status)
+        return make_response(jsonify(
+          error='Operation {} ({} {}): {}'.format(index, operation['method'],
+                                                  operation['path'], error),
+          operation=index), response.status_code)
+
+      if response.status_code == 204:
+        body = None
+
+      results.append({'status': response.status_code, 'body': body})
+    timings.mark('operations')
+  finally:
+    g.batch = False
+
+  db.session.commit()
+  timings.mark('commit')
+  return timings.apply(jsonify(results))
+
 if __name__ == "__main__":
   if sys.argv[1] == 'initdb':
     init_db()
@@ -61,7 +61,8 @@ setup(name= 'bmgr', version= '0.7.0', description= 'Simple iPXE boot manager',
       ''',
       install_requires=['Flask', 'Flask-SQLAlchemy', 'ClusterShell',
                         'flask-expects-json', 'requests', 'click', 'mysqlclient',
-                        'texttable', 'responses'],
+                        'texttable', 'responses', 'PyYAML'],
+      extras_require={'async': ['aiohttp']},
       cmdclass={'bdist_rpm': bmgr_bdist_rpm,
                 'install': bmgr_install}
 )
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import pytest
+import bmgr
+import bmgr.server
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web
+from werkzeug.serving import make_server
+from bmgr.aioclient import AsyncClient
+
+@pytest.fixture
+def server_url():
+    db_fd, db_path = tempfile.mkstemp()
+    template_path = tempfile.mkdtemp()
+
+    app = bmgr.create_app({
+       'BMGR_DB_URI': 'sqlite:///{0}'.format(db_path),
+       'TESTING': True,
+       'BMGR_TEMPLATE_PATH': template_path
+       })
+    with app.app_context():
+        bmgr.server.init_db()
+
+    with open(os.path.join(template_path, 'hostname.jinja'), 'w+') as f:
+        f.write('hostname: {{ hostname }} a: {{ a }}')
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    yield 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    server.shutdown()
+    thread.join()
+    os.close(db_fd)
+    os.unlink(db_path)
+    shutil.rmtree(template_path)
+
+def test_aioclient(server_url):
+    async def run():
+        async with AsyncClient(server_url, limit=4, concurrency=8) as c:
+            await c.add_profile('profileA', [('a', '1')])
+            await asyncio.gather(*[c.add_hosts('node[{}-{}]'.format(i, i + 9),
+                                               ['profileA'])
+                                   for i in range(0, 100, 10)])
+            await c.add_resource('hostname', 'file://hostname.jinja')
+            await c.add_alias('boot', 'hostname')
+            await c.add_override('boot', 'node[0-9]', 'hostname', True)
+
+            outputs = await asyncio.gather(*[
+                c.render_resource('boot', 'node{}'.format(i))
+                for i in range(100)])
+            assert outputs == ['hostname: node{} a: 1'.format(i)
+                               for i in range(100)]
+
+            hosts = await c.get_hosts()
+            assert hosts[0]['name'] == 'node[0-99]'
+            assert [h async for h in c.iter_hosts()] == hosts
+
+            renders = [r async for r in c.render_resources('hostname',
+                                                           'node[0-99]')]
+            assert sorted(r['output'] for r in renders) == sorted(outputs)
+
+            await c.update_profile('profileA', [('a', '2'), ('b', '3')])
+            assert (await c.get_profile('profileA'))['attributes'] == \
+                {'a': '2', 'b': '3'}
+
+            with pytest.raises(aiohttp.ClientResponseError) as e:
+                await c.get_profile('profileB')
+            assert e.value.status == 404
+            assert e.value.message == "Profile 'profileB' not found"
+
+    asyncio.run(run())
+
+def test_aioclient_retry():
+    calls = []
+
+    async def flaky(request):
+        calls.append(request.path)
+        if len(calls) < 3:
+            return web.json_response({'error': 'unavailable'}, status=503)
+        return web.json_response([])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/v1.0/profiles', flaky)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            url = 'http://127.0.0.1:{}'.format(port)
+            async with AsyncClient(url, backoff=0.01) as c:
+                assert await c.get_profiles() == []
+                assert len(calls) == 3
+
+            del calls[:]
+            async with AsyncClient(url, retries=1, backoff=0.01) as c:
+                with pytest.raises(aiohttp.ClientResponseError) as e:
+                    await c.get_profiles()
+                assert e.value.status == 503
+                assert e.value.message == 'unavailable'
+                assert len(calls) == 2
+        finally:
+            await runner.cleanup()
+
+        # Connection errors are retried before giving up
+        async with AsyncClient(url, retries=2, backoff=0.01) as c:
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await c.get_profiles()
+
+    asyncio.run(run())
+
+def test_aioclient_no_retry_writes():
+    calls = []
+
+    async def unavailable(request):
+        calls.append(request.path)
+        return web.json_response({'error': 'unavailable'}, status=503)
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/api/v1.0/profiles', unavailable)
+        app.router.add_get('/api/v1.0/resources/boot/node1', unavailable)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            url = 'http://127.0.0.1:{}'.format(port)
+            # Writes and renders may have been applied before the failure
+            async with AsyncClient(url, backoff=0.01) as c:
+                with pytest.raises(aiohttp.ClientResponseError) as e:
+                    await c.add_profile('profileA')
+                assert e.value.status == 503
+                assert len(calls) == 1
+
+                with pytest.raises(aiohttp.ClientResponseError) as e:
+                    await c.render_resource('boot', 'node1')
+                assert e.value.status == 503
+                assert len(calls) == 2
+
+            del calls[:]
+            async with AsyncClient(url, retries=2, backoff=0.01,
+                                   retry_writes=True) as c:
+                with pytest.raises(aiohttp.ClientResponseError):
+                    await c.add_profile('profileA')
+                assert len(calls) == 3
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
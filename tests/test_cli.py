@@ -2,6 +2,7 @@ import pytest
 import responses
 import requests
 import os
+import json
 from bmgr.scripts.cmd import cli
 from click.testing import CliRunner
 
@@ -49,3 +50,183 @@ def test_profiles_list_cli(runner):
     assert "a1" in result.output
     assert "a2" in result.output
     assert result.exit_code == 0
+
+@responses.activate
+def test_profiles_update_cli(runner):
+    responses.add(responses.PATCH,
+                  'http://testapi.com/api/v1.0/profiles/profileA',
+                  json={"name": "profileA", "attributes": {"a1": "2"},
+                        "weight": 5},
+                  status=200)
+
+    result = runner.invoke(cli, ['profile', 'update', 'profileA',
+                                 '--attr', 'a1', '2', '--del-attr', 'a2'])
+    assert result.exit_code == 0
+
+    # The attributes are patched in a single request
+    assert len(responses.calls) == 1
+    request = responses.calls[0].request
+    assert request.headers['Content-Type'] == 'application/merge-patch+json'
+    assert json.loads(request.body) == {'name': 'profileA',
+                                        'attributes': {'a1': '2', 'a2': None}}
+
+@responses.activate
+def test_hosts_list_cli_stream(runner):
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/hosts',
+                  body='{"name": "node[0-9]", "profiles": ["profileA"]}\n'
+                       '{"name": "node[10-19]", "profiles": ["profileB"]}\n',
+                  content_type='application/x-ndjson', status=200)
+
+    result = runner.invoke(cli, ['host', 'list'])
+    assert "profileA   node[0-9]" in result.output
+    assert "profileB   node[10-19]" in result.output
+    assert result.exit_code == 0
+    assert responses.calls[0].request.params == {'format': 'ndjson'}
+
+@responses.activate
+def test_hosts_list_cli_where(runner):
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/hosts',
+                  json=[{'name': 'node[0-9]', 'profiles': ['profileA']}],
+                  status=200)
+
+    result = runner.invoke(cli, ['host', 'list', '-w', 'netdev=ib0',
+                                 '--where', 'os=el8'])
+    assert "profileA   node[0-9]" in result.output
+    assert result.exit_code == 0
+    assert responses.calls[0].request.params == {
+        'where': ['netdev=ib0', 'os=el8'], 'format': 'ndjson'}
+
+    result = runner.invoke(cli, ['host', 'list', '-w', 'netdev'])
+    assert 'Invalid attribute filter' in result.output
+    assert result.exit_code != 0
+
+@responses.activate
+def test_resources_render_cli(runner, tmpdir):
+    responses.add(responses.POST,
+                  'http://testapi.com/api/v1.0/resources/boot/render',
+                  body='{"name": "node1", "resource": "boot", "output": "b1"}\n'
+                       '{"name": "node2", "resource": "boot", "output": "b2"}\n',
+                  content_type='application/x-ndjson', status=200)
+
+    result = runner.invoke(cli, ['resource', 'render', '--dry-run',
+                                 'boot', 'node[1-2]'])
+    assert result.exit_code == 0
+    assert "==> node1 (boot) <==\nb1\n==> node2 (boot) <==\nb2" in result.output
+    assert json.loads(responses.calls[0].request.body) == {
+        'hosts': 'node[1-2]', 'dry_run': True}
+
+    result = runner.invoke(cli, ['resource', 'render', '-o', str(tmpdir),
+                                 'boot', 'node[1-2]'])
+    assert result.exit_code == 0
+    assert tmpdir.join('node2').read() == 'b2'
+
+@responses.activate
+def test_client_cache(tmpdir):
+    from bmgr.client import Client
+
+    profiles = [{'name': 'profileA', 'attributes': {'a1': '1'}, 'weight': 0}]
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/profiles',
+                  json=profiles, headers={'ETag': '"v1"'}, status=200)
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/profiles',
+                  body='', headers={'ETag': '"v1"'}, status=304)
+
+    c = Client('http://testapi.com/', cache_dir=str(tmpdir.join('cache')))
+    assert c.get_profiles() == profiles
+    assert 'If-None-Match' not in responses.calls[0].request.headers
+
+    # A new client revalidates the response cached on disk
+    c = Client('http://testapi.com/', cache_dir=str(tmpdir.join('cache')))
+    assert c.get_profiles() == profiles
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+@responses.activate
+def test_hosts_list_cli_cache(runner, tmpdir, monkeypatch):
+    body = '{"name": "node[0-9]", "profiles": ["profileA"]}\n'
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/hosts',
+                  body=body, content_type='application/x-ndjson',
+                  headers={'ETag': '"v1"'}, status=200)
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/hosts',
+                  body='', headers={'ETag': '"v1"'}, status=304)
+
+    monkeypatch.setenv('BMGR_CLIENT_CACHE', str(tmpdir))
+    for i in range(2):
+        result = runner.invoke(cli, ['host', 'list'])
+        assert result.exit_code == 0
+        assert "profileA   node[0-9]" in result.output
+
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+@responses.activate
+def test_apply_cli(runner, tmpdir):
+    responses.add(responses.POST, 'http://testapi.com/api/v1.0/batch',
+                  json=[{'status': 200, 'body': {}},
+                        {'status': 204, 'body': None}], status=200)
+
+    batch = tmpdir.join('batch.yaml')
+    batch.write('operations:\n'
+                '  - method: POST\n'
+                '    path: profiles\n'
+                '    body: {name: deploy, attributes: {os: el8}}\n'
+                '  - method: PATCH\n'
+                '    path: profiles/compute\n'
+                '    body: {attributes: {kernel: null}}\n'
+                '    headers: {Content-Type: application/merge-patch+json,\n'
+                '              If-Match: \'"v1"\'}\n'
+                '  - method: DELETE\n'
+                '    path: /api/v1.0/hosts/node[0-4]\n')
+
+    result = runner.invoke(cli, ['apply', str(batch)])
+    assert result.exit_code == 0
+    assert '2 operations applied' in result.output
+    assert json.loads(responses.calls[0].request.body) == {'operations': [
+        {'method': 'POST', 'path': '/api/v1.0/profiles',
+         'body': {'name': 'deploy', 'attributes': {'os': 'el8'}}},
+        {'method': 'PATCH', 'path': '/api/v1.0/profiles/compute',
+         'body': {'attributes': {'kernel': None}},
+         'headers': {'Content-Type': 'application/merge-patch+json',
+                     'If-Match': '"v1"'}},
+        {'method': 'DELETE', 'path': '/api/v1.0/hosts/node[0-4]'}]}
+
+    for invalid in ('- method: POST\n',
+                    '- {method: DELETE, path: hosts/node0, headers: x}\n'):
+        batch.write(invalid)
+        result = runner.invoke(cli, ['apply', str(batch)])
+        assert result.exit_code == 1
+        assert 'Invalid batch file' in result.output
+    assert len(responses.calls) == 1
+
+@responses.activate
+def test_export_import_cli(runner, tmpdir):
+    inventory = {'profiles': [{'name': 'profileA', 'attributes': {'a': '1'},
+                               'weight': 0}],
+                 'resources': [{'name': 'boot',
+                                'template_uri': 'file://boot.jinja'}],
+                 'hosts': [{'name': 'node[0-9]', 'profiles': ['profileA']}],
+                 'aliases': [{'name': 'ipxe_boot', 'target': 'boot',
+                              'overrides': {}}]}
+    responses.add(responses.GET, 'http://testapi.com/api/v1.0/inventory',
+                  json=inventory, status=200)
+    changes = dict((kind, {'added': 0, 'updated': 0, 'deleted': 0})
+                   for kind in ('resources', 'profiles', 'hosts', 'aliases',
+                                'overrides'))
+    changes['hosts']['added'] = 10
+    responses.add(responses.PUT, 'http://testapi.com/api/v1.0/inventory',
+                  json=changes, status=200)
+
+    output = tmpdir.join('inventory.yaml')
+    result = runner.invoke(cli, ['export', '-f', 'yaml', str(output)])
+    assert result.exit_code == 0
+    assert 'name: node[0-9]' in output.read()
+
+    result = runner.invoke(cli, ['import', '--dry-run', str(output)])
+    assert result.exit_code == 0
+    assert 'hosts' in result.output
+    assert '10' in result.output
+    request = responses.calls[1].request
+    assert request.params == {'dry_run': 'true'}
+    assert json.loads(request.body) == inventory
+
+    result = runner.invoke(cli, ['export'])
+    assert result.exit_code == 0
+    assert json.loads(result.output) == inventory
+
@@ -3,9 +3,16 @@ import tempfile
 import pytest
 import bmgr
 import bmgr.server
+import bmgr.migrations as migrations
 import shutil
+import contextlib
+import threading
+import time
+import json
+import datetime
 
 from ClusterShell.NodeSet import NodeSet as nodeset
+from sqlalchemy import event, inspect
 
 @pytest.fixture
 def client():
@@ -34,6 +41,8 @@ def client():
         f.write('hostname: {{ hostname }}')
     with open(os.path.join(template_path, 'defined.jinja'), 'w+') as f:
         f.write('{{ c + 2 }}')
+    with open(os.path.join(template_path, 'kstemplate.jinja'), 'w+') as f:
+        f.write('ks: {{ hostname }}')
 
 
     yield client
@@ -42,6 +51,22 @@ def client():
     os.unlink(db_path)
     shutil.rmtree(template_path)
 
+@contextlib.contextmanager
+def count_queries(client):
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    with client.application.app_context():
+        engine = bmgr.server.db.engine
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
 def assert_empty_hosts(client):
     r = client.get('/api/v1.0/hosts')
     assert r.status_code == 200
@@ -383,15 +408,88 @@ def test_resources(client):
     assert 'undefined' in r.get_json()['error']
 
 
-    # Render a bad profile
+    # Missing templates are rejected
     r = client.patch('/api/v1.0/resources/boot',
                     json = {'name': 'boot',
                     'template_uri': 'file://bad.jinja'})
-
-    r = client.get('/api/v1.0/resources/boot/node0')
     assert r.status_code == 400
     assert 'bad.jinja' in r.get_json()['error']
 
+    r = client.get('/api/v1.0/resources/boot')
+    assert r.get_json()['template_uri'] == 'file://defined.jinja'
+
+
+def test_resources_validation(client, caplog, tmpdir):
+    template_path = client.application.config['BMGR_TEMPLATE_PATH']
+    with open(os.path.join(template_path, 'syntax.jinja'), 'w+') as f:
+        f.write('line 1\n{% if a %}')
+
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'syntax',
+                            'template_uri': 'file://syntax.jinja'})
+    assert r.status_code == 400
+    assert r.get_json()['error'].startswith('Error while compiling template')
+    assert '(line 2)' in r.get_json()['error']
+
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'missing',
+                            'template_uri': 'file://missing.jinja'})
+    assert r.status_code == 400
+    assert r.get_json()['error'].startswith('Template not found on server')
+    assert 'missing.jinja' in r.get_json()['error']
+
+    r = client.get('/api/v1.0/resources/missing')
+    assert r.status_code == 404
+
+    # Templates are compiled when the resource is created
+    client.delete('/api/v1.0/cache')
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'boot',
+                            'template_uri': 'file://boot.jinja'})
+    assert r.status_code == 200
+    assert client.get('/api/v1.0/cache').get_json()['templates'] == \
+        {'hits': 0, 'misses': 1, 'size': 1}
+
+    r = client.post('/api/v1.0/hosts', json = { 'name': 'node0' })
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/resources/boot/node0')
+    assert r.status_code == 200
+    assert client.get('/api/v1.0/cache').get_json()['templates']['misses'] == 1
+    assert "Template 'boot.jinja' references undefined attributes for host " \
+        "'node0': a, b" in caplog.text
+
+    # Compiled templates can be shared on disk between processes
+    bytecode_dir = str(tmpdir)
+    cache = bmgr.server.TemplateCache(template_path,
+                                      bytecode_cache_dir=bytecode_dir)
+    parses = []
+
+    def count_parses(cache):
+        parse = cache.env._parse
+        def wrapper(*args):
+            parses.append(args)
+            return parse(*args)
+        cache.env._parse = wrapper
+
+    count_parses(cache)
+    variables = cache.get('boot.jinja').variables
+    assert variables == frozenset(['a', 'b'])
+    assert len(parses) == 1
+    # The bytecode and the template variables
+    assert len(tmpdir.listdir()) == 2
+
+    # Another process neither parses nor compiles the template again
+    cache = bmgr.server.TemplateCache(template_path,
+                                      bytecode_cache_dir=bytecode_dir)
+    count_parses(cache)
+    tpl = cache.get('boot.jinja')
+    assert tpl.template.render(a=1, b=2) == 'boot: a: 1 b: 2'
+    assert tpl.variables == variables
+    assert len(parses) == 1
+    cache.clear()
+    assert tmpdir.listdir() == []
+
 
 def test_aliases(client):
     # Check default aliases
@@ -556,3 +654,1225 @@ def test_aliases(client):
     assert r.status_code == 204
     r = client.delete('/api/v1.0/aliases/myalias2')
     assert r.status_code == 204
+
+def test_template_cache(client):
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node0' })
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'hostname',
+                    'template_uri': 'file://hostname.jinja'})
+    assert r.status_code == 200
+
+    r = client.delete('/api/v1.0/cache')
+    assert r.status_code == 204
+
+    # First rendering compiles the template, the next ones reuse it
+    for i in range(3):
+        r = client.get('/api/v1.0/resources/hostname/node0')
+        assert r.status_code == 200
+        assert r.get_data(as_text=True) == 'hostname: node0'
+
+    r = client.get('/api/v1.0/cache')
+    assert r.status_code == 200
+    assert r.get_json()['templates'] == {'hits': 2, 'misses': 1, 'size': 1}
+
+    # Modifying the template invalidates the compiled version
+    template_path = client.application.config['BMGR_TEMPLATE_PATH']
+    template_file = os.path.join(template_path, 'hostname.jinja')
+    with open(template_file, 'w') as f:
+        f.write('new hostname: {{ hostname }}')
+    mtime = os.path.getmtime(template_file) + 10
+    os.utime(template_file, (mtime, mtime))
+
+    r = client.get('/api/v1.0/resources/hostname/node0')
+    assert r.status_code == 200
+    assert r.get_data(as_text=True) == 'new hostname: node0'
+
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['templates'] == {'hits': 2, 'misses': 2, 'size': 1}
+
+def test_render_queries(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA', 'attributes': {'a': '1'}})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-1]', 'profiles': ['profileA'] })
+    assert r.status_code == 200
+
+    for res in ('boot', 'deploy'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases',
+                    json={'name': 'myalias', 'target': 'boot'})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases/myalias',
+                    json={'target': 'deploy', 'hosts': 'node1'})
+    assert r.status_code == 200
+
+    # Resources, aliases and overrides are all resolved with a single query
+    for path, expect in (('boot/node0', 'boot: a: 1 b: '),
+                         ('myalias/node0', 'boot: a: 1 b: '),
+                         ('myalias/node1', 'deploy: a: 1 b: ')):
+        with count_queries(client) as queries:
+            r = client.get('/api/v1.0/resources/' + path)
+        assert r.status_code == 200
+        assert r.get_data(as_text=True) == expect
+        assert len(queries) == 1
+
+    r = client.get('/api/v1.0/resources/boot/node2')
+    assert r.status_code == 404
+    assert r.get_json() == {'error': "Host 'node2' not found"}
+
+    r = client.get('/api/v1.0/resources/bad/node0')
+    assert r.status_code == 404
+    assert r.get_json() == {'error': "Resource 'bad' not found"}
+
+def test_attributes_cache(client):
+    for p in ({'name': 'profileA', 'attributes': {'a': '1', 'b': '1'}},
+              {'name': 'profileB', 'attributes': {'b': '2'}, 'weight': 10}):
+        r = client.post('/api/v1.0/profiles', json = p)
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-9]',
+                             'profiles': ['profileA', 'profileB'] })
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'boot',
+                            'template_uri': 'file://boot.jinja'})
+    assert r.status_code == 200
+
+    r = client.delete('/api/v1.0/cache')
+    assert r.status_code == 204
+
+    # Attributes are merged once for all hosts sharing the same profiles
+    for host in nodeset('node[0-9]'):
+        r = client.get('/api/v1.0/resources/boot/{}'.format(host))
+        assert r.status_code == 200
+        assert r.get_data(as_text=True) == 'boot: a: 1 b: 2'
+
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['attributes'] == {'hits': 9, 'misses': 1, 'size': 1}
+
+    # Updating a profile drops the merged attributes depending on it
+    r = client.patch('/api/v1.0/profiles/profileB',
+                     json = {'weight': -10})
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['attributes']['size'] == 0
+
+    r = client.get('/api/v1.0/resources/boot/node0')
+    assert r.status_code == 200
+    assert r.get_data(as_text=True) == 'boot: a: 1 b: 1'
+
+def test_deep_merge(client):
+    attributes = (
+        {'net': {'ib0': {'ip': '10.0.0.1', 'mtu': 2044}, 'eth0': 'dhcp'},
+         'kernel': ['quiet', 'console=tty0'], 'os': 'el7'},
+        {'net': {'ib0': {'mtu': 65520}}, 'kernel': ['debug']})
+    for i, a in enumerate(attributes):
+        r = client.post('/api/v1.0/profiles',
+                        json = {'name': 'profile{}'.format(i),
+                                'attributes': a, 'weight': i})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-9]',
+                             'profiles': ['profile0', 'profile1'] })
+    assert r.status_code == 200
+
+    # Flat merging replaces top-level values
+    r = client.get('/api/v1.0/hosts')
+    assert r.get_json()[0]['attributes'] == {
+        'net': {'ib0': {'mtu': 65520}}, 'kernel': ['debug'], 'os': 'el7'}
+
+    # Nested dicts are merged, heavier profiles replace lists and values
+    client.application.config['BMGR_DEEP_MERGE'] = True
+    client.delete('/api/v1.0/cache')
+    r = client.get('/api/v1.0/hosts')
+    assert r.get_json()[0]['attributes'] == {
+        'net': {'ib0': {'ip': '10.0.0.1', 'mtu': 65520}, 'eth0': 'dhcp'},
+        'kernel': ['debug'], 'os': 'el7'}
+
+    # Profiles are left untouched
+    r = client.get('/api/v1.0/profiles/profile0')
+    assert r.get_json()['attributes'] == attributes[0]
+
+    # The merge is computed once per combination of profiles
+    for host in nodeset('node[0-9]'):
+        r = client.get('/api/v1.0/hosts/{}'.format(host))
+        assert r.get_json()[0]['attributes']['net']['ib0']['mtu'] == 65520
+
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['attributes'] == {'hits': 10, 'misses': 1, 'size': 1}
+
+def test_render_cache(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA', 'attributes': {'a': '1'}})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-4]', 'profiles': ['profileA'] })
+    assert r.status_code == 200
+
+    for res in ('boot', 'hostname'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.delete('/api/v1.0/cache')
+    assert r.status_code == 204
+
+    # Outputs which do not depend on the hostname are rendered once
+    etags = set()
+    for host in nodeset('node[0-4]'):
+        r = client.get('/api/v1.0/resources/boot/{}'.format(host))
+        assert r.status_code == 200
+        assert r.get_data(as_text=True) == 'boot: a: 1 b: '
+        etags.add(r.headers['ETag'])
+
+        r = client.get('/api/v1.0/resources/hostname/{}'.format(host))
+        assert r.status_code == 200
+        assert r.get_data(as_text=True) == 'hostname: {}'.format(host)
+
+    assert len(etags) == 1
+
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['renders'] == {'hits': 4, 'misses': 6, 'size': 6}
+
+    # Conditional requests
+    r = client.get('/api/v1.0/resources/boot/node0',
+                   headers={'If-None-Match': etags.pop()})
+    assert r.status_code == 304
+    assert r.get_data(as_text=True) == ''
+
+    # Profile updates are reflected in the output
+    r = client.patch('/api/v1.0/profiles/profileA',
+                     json = {'attributes': {'a': '2'}})
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['renders']['size'] == 0
+
+    r = client.get('/api/v1.0/resources/boot/node0')
+    assert r.status_code == 200
+    assert r.get_data(as_text=True) == 'boot: a: 2 b: '
+
+    # And so are resource updates
+    r = client.patch('/api/v1.0/resources/boot',
+                     json = {'template_uri': 'file://deploy.jinja'})
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/resources/boot/node0')
+    assert r.status_code == 200
+    assert r.get_data(as_text=True) == 'deploy: a: 2 b: '
+
+def test_render_cache_includes(client):
+    template_path = client.application.config['BMGR_TEMPLATE_PATH']
+
+    def write(name, content):
+        template_file = os.path.join(template_path, name)
+        with open(template_file, 'w') as f:
+            f.write(content)
+        # Make sure the modification time changes
+        mtime = time.time() + 10 * len(content)
+        os.utime(template_file, (mtime, mtime))
+
+    write('inc.jinja', 'INC v1')
+    write('main.jinja', 'main: {% include "inc.jinja" %}')
+    write('dynamic.jinja', '{% include name %}')
+
+    r = client.post('/api/v1.0/hosts', json = { 'name': 'node0' })
+    assert r.status_code == 200
+
+    for res in ('main', 'dynamic'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA',
+                            'attributes': {'name': 'inc.jinja'}})
+    assert r.status_code == 200
+    r = client.patch('/api/v1.0/hosts/node0', json = {'profiles': ['profileA']})
+    assert r.status_code == 200
+
+    for i in range(2):
+        r = client.get('/api/v1.0/resources/main/node0')
+        assert r.get_data(as_text=True) == 'main: INC v1'
+        r = client.get('/api/v1.0/resources/dynamic/node0')
+        assert r.get_data(as_text=True) == 'INC v1'
+
+    # Only the output of the template with a known include is cached
+    r = client.get('/api/v1.0/cache')
+    assert r.get_json()['renders']['size'] == 1
+
+    # Modifying an included template invalidates the cached outputs
+    write('inc.jinja', 'INC v2 ')
+    r = client.get('/api/v1.0/resources/main/node0')
+    assert r.get_data(as_text=True) == 'main: INC v2 '
+    r = client.get('/api/v1.0/resources/dynamic/node0')
+    assert r.get_data(as_text=True) == 'INC v2 '
+
+    r = client.post('/api/v1.0/resources/main/render',
+                    json = {'hosts': 'node0'})
+    assert json.loads(r.get_data(as_text=True))['output'] == 'main: INC v2 '
+
+def test_hosts_bulk_add(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA', 'attributes': {'a': '1'}})
+    assert r.status_code == 200
+
+    # Profiles are resolved once whatever the number of hosts
+    with count_queries(client) as queries:
+        r = client.post('/api/v1.0/hosts',
+                        json = { 'name': 'node[0-2999]',
+                                 'profiles': ['profileA', 'profileA'] })
+    assert r.status_code == 200
+    assert r.get_json() == [{'name': 'node[0-2999]',
+                             'profiles': ['profileA'],
+                             'attributes': {'a': '1'}}]
+    assert len([q for q in queries if 'FROM profiles' in q]) <= 2
+
+    phases = [t.split(';')[0].strip()
+              for t in r.headers['Server-Timing'].split(',')]
+    assert phases == ['profiles', 'insert', 'commit', 'fold']
+
+    # Conflicting hosts are not created
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[2999-3001]' })
+    assert r.status_code == 409
+
+    r = client.get('/api/v1.0/hosts')
+    assert r.get_json()[0]['name'] == 'node[0-2999]'
+
+def test_hosts_bulk_update(client):
+    for p in ({'name': 'profileA', 'attributes': {'a': '1'}},
+              {'name': 'profileB', 'attributes': {'a': '2'}, 'weight': 10}):
+        r = client.post('/api/v1.0/profiles', json = p)
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-2999]', 'profiles': ['profileA'] })
+    assert r.status_code == 200
+
+    # Profiles are replaced without loading hosts
+    with count_queries(client) as queries:
+        r = client.patch('/api/v1.0/hosts/node[1000-2999]',
+                         json = {'profiles': ['profileB', 'profileA']})
+    assert r.status_code == 200
+    assert r.get_json() == [{'name': 'node[1000-2999]',
+                             'profiles': ['profileB', 'profileA'],
+                             'attributes': {'a': '2'}}]
+    assert len(queries) < 20
+
+    r = client.get('/api/v1.0/hosts')
+    assert dict_sorted_list(r.get_json()) == dict_sorted_list([
+        {'name': 'node[0-999]',
+         'profiles': ['profileA'],
+         'attributes': {'a': '1'}},
+        {'name': 'node[1000-2999]',
+         'profiles': ['profileB', 'profileA'],
+         'attributes': {'a': '2'}}])
+
+    r = client.patch('/api/v1.0/hosts/node[0-3000]',
+                     json = {'profiles': []})
+    assert r.status_code == 404
+
+def test_hosts_bulk_delete(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA', 'attributes': {'a': '1'}})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-2999]', 'profiles': ['profileA'] })
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases/ipxe_boot',
+                    json={'target': 'ipxe_deploy_boot',
+                          'hosts': 'node[0-1999]'})
+    assert r.status_code == 200
+
+    r = client.delete('/api/v1.0/hosts/node[1000-3000]')
+    assert r.status_code == 404
+
+    # Hosts, overrides and profile associations are deleted together
+    with count_queries(client) as queries:
+        r = client.delete('/api/v1.0/hosts/node[1000-2999]')
+    assert r.status_code == 204
+    assert len(queries) < 20
+
+    r = client.get('/api/v1.0/hosts')
+    assert r.get_json() == [{'name': 'node[0-999]',
+                             'profiles': ['profileA'],
+                             'attributes': {'a': '1'}}]
+
+    r = client.get('/api/v1.0/aliases/ipxe_boot')
+    assert r.get_json()['overrides'] == {
+        'node[0-999]': {'target': 'ipxe_deploy_boot', 'autodelete': False}}
+
+    with client.application.app_context():
+        count = bmgr.server.db.session.query(
+            bmgr.server.host_profiles_table).count()
+    assert count == 1000
+
+def test_hosts_folding(client):
+    for p in ({'name': 'profileA', 'attributes': {'a': '1'}},
+              {'name': 'profileB', 'attributes': {'a': '2'}, 'weight': 10}):
+        r = client.post('/api/v1.0/profiles', json = p)
+        assert r.status_code == 200
+
+    for hosts, profiles in (('node[0-999]', ['profileA']),
+                            ('node[1000-1999]', ['profileB', 'profileA']),
+                            ('node[2000-2999]', ['profileA', 'profileB']),
+                            ('node[3000-3999]', [])):
+        r = client.post('/api/v1.0/hosts',
+                        json = { 'name': hosts, 'profiles': profiles })
+        assert r.status_code == 200
+
+    # Listing does not depend on the number of hosts or groups, the first
+    # query reads the change counters
+    with count_queries(client) as queries:
+        r = client.get('/api/v1.0/hosts')
+    assert r.status_code == 200
+    assert len(queries) == 3
+    assert r.get_json() == [
+        {'name': 'node[3000-3999]', 'profiles': [], 'attributes': {}},
+        {'name': 'node[0-999]', 'profiles': ['profileA'],
+         'attributes': {'a': '1'}},
+        {'name': 'node[1000-2999]', 'profiles': ['profileB', 'profileA'],
+         'attributes': {'a': '2'}}]
+
+    r = client.get('/api/v1.0/hosts/node[999-1000,3000]')
+    assert r.status_code == 200
+    assert r.get_json() == [
+        {'name': 'node3000', 'profiles': [], 'attributes': {}},
+        {'name': 'node999', 'profiles': ['profileA'],
+         'attributes': {'a': '1'}},
+        {'name': 'node1000', 'profiles': ['profileB', 'profileA'],
+         'attributes': {'a': '2'}}]
+
+def test_conditional_requests(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA', 'attributes': {'a': '1'}})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-9]', 'profiles': ['profileA'] })
+    assert r.status_code == 200
+
+    urls = ('/api/v1.0/hosts', '/api/v1.0/hosts/node1', '/api/v1.0/profiles',
+            '/api/v1.0/profiles/profileA', '/api/v1.0/resources',
+            '/api/v1.0/resources/kickstart', '/api/v1.0/aliases',
+            '/api/v1.0/aliases/ipxe_boot')
+    etags = {}
+    for url in urls:
+        r = client.get(url)
+        assert r.status_code == 200
+        # A profile is tagged with its version, which has no date, and
+        # consuming an override does not record a date
+        if url == '/api/v1.0/profiles/profileA' or 'aliases' in url:
+            assert 'Last-Modified' not in r.headers
+        else:
+            assert r.headers['Last-Modified']
+        etags[url] = r.headers['ETag']
+
+        # Unchanged listings are not read again
+        with count_queries(client) as queries:
+            r = client.get(url, headers={'If-None-Match': etags[url]})
+        assert r.status_code == 304
+        assert r.get_data() == b''
+        assert r.headers['ETag'] == etags[url]
+        assert len(queries) == 1
+
+    def changed():
+        return set(url for url in urls
+                   if client.get(url, headers={
+                       'If-None-Match': etags[url]}).status_code == 200)
+
+    r = client.patch('/api/v1.0/profiles/profileA',
+                     json = {'attributes': {'a': '2'}})
+    assert r.status_code == 200
+    assert changed() == set(['/api/v1.0/hosts', '/api/v1.0/hosts/node1',
+                             '/api/v1.0/profiles',
+                             '/api/v1.0/profiles/profileA'])
+
+    for url in urls:
+        etags[url] = client.get(url).headers['ETag']
+
+    r = client.post('/api/v1.0/aliases/ipxe_boot',
+                    json={'target': 'kickstart', 'hosts': 'node1',
+                          'autodelete': True})
+    assert r.status_code == 200
+    assert changed() == set(['/api/v1.0/aliases',
+                             '/api/v1.0/aliases/ipxe_boot'])
+
+    # Consuming a oneshot override is a change
+    for url in urls:
+        etags[url] = client.get(url).headers['ETag']
+    with open(os.path.join(client.application.config['BMGR_TEMPLATE_PATH'],
+                           'ks_rhel7.jinja'), 'w+') as f:
+        f.write('ks')
+    # without writing to the shared counters
+    with count_queries(client) as queries:
+        r = client.get('/api/v1.0/resources/ipxe_boot/node1')
+    assert r.status_code == 200
+    assert not [q for q in queries if 'change_counters' in q]
+    assert changed() == set(['/api/v1.0/aliases',
+                             '/api/v1.0/aliases/ipxe_boot'])
+
+    # Errors are not cached
+    r = client.get('/api/v1.0/profiles/profileB')
+    assert r.status_code == 404
+    assert 'ETag' not in r.headers
+
+def test_conditional_same_second(client, monkeypatch):
+    class FakeDatetime(datetime.datetime):
+        now = datetime.datetime(2020, 1, 1, 12, 0, 0, 100000)
+
+        @classmethod
+        def utcnow(cls):
+            return cls.now
+
+    monkeypatch.setattr(bmgr.server.datetime, 'datetime', FakeDatetime)
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'boot', 'template_uri': 'file://boot.jinja'})
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/resources')
+    assert r.headers['Last-Modified'] == 'Wed, 01 Jan 2020 12:00:00 GMT'
+    last_modified = r.headers['Last-Modified']
+    resources = len(r.get_json())
+
+    # A change made in the same second is not hidden by the date
+    FakeDatetime.now = FakeDatetime.now.replace(microsecond=900000)
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'deploy',
+                            'template_uri': 'file://deploy.jinja'})
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/resources',
+                   headers={'If-Modified-Since': last_modified})
+    assert r.status_code == 200
+    assert r.headers['Last-Modified'] == last_modified
+    assert len(r.get_json()) == resources + 1
+
+    r = client.get('/api/v1.0/resources',
+                   headers={'If-Modified-Since':
+                            'Wed, 01 Jan 2020 12:00:01 GMT'})
+    assert r.status_code == 304
+
+def test_hosts_where(client):
+    for p in ({'name': 'profileA', 'attributes': {'netdev': 'ib0', 'os': 'el7'}},
+              {'name': 'profileB', 'attributes': {'netdev': 'eth0'},
+               'weight': 10},
+              {'name': 'profileC', 'attributes': {'os': 'el8'}, 'weight': 5}):
+        r = client.post('/api/v1.0/profiles', json = p)
+        assert r.status_code == 200
+
+    for hosts, profiles in (('node[0-99]', ['profileA']),
+                            ('node[100-199]', ['profileA', 'profileB']),
+                            ('node[200-299]', ['profileA', 'profileC']),
+                            ('node[300-399]', ['profileC'])):
+        r = client.post('/api/v1.0/hosts',
+                        json = { 'name': hosts, 'profiles': profiles })
+        assert r.status_code == 200
+
+    # Heavier profiles override the value of lighter ones
+    r = client.get('/api/v1.0/hosts?where=netdev=ib0')
+    assert r.status_code == 200
+    assert [h['name'] for h in r.get_json()] == ['node[0-99]', 'node[200-299]']
+
+    r = client.get('/api/v1.0/hosts?where=netdev=ib0&where=os=el8')
+    assert r.status_code == 200
+    assert r.get_json() == [
+        {'name': 'node[200-299]', 'profiles': ['profileC', 'profileA'],
+         'attributes': {'netdev': 'ib0', 'os': 'el8'}}]
+
+    r = client.get('/api/v1.0/hosts?where=os=el7&format=ndjson')
+    assert r.status_code == 200
+    lines = r.get_data(as_text=True).splitlines()
+    assert [json.loads(l)['name'] for l in lines] == ['node[0-99]',
+                                                      'node[100-199]']
+
+    r = client.get('/api/v1.0/hosts?where=netdev=none')
+    assert r.status_code == 200
+    assert r.get_json() == []
+
+    # Only hosts having a matching profile are read
+    with count_queries(client) as queries:
+        r = client.get('/api/v1.0/hosts?where=netdev=eth0')
+    assert r.get_json()[0]['name'] == 'node[100-199]'
+    assert len(queries) == 3
+    assert 'profile_id IN (SELECT' in queries[1]
+
+    r = client.get('/api/v1.0/hosts?where=netdev')
+    assert r.status_code == 400
+
+def test_streaming(client):
+    for hosts, profiles in (('node[0-9]', []), ('node[10-19]', ['profileA'])):
+        r = client.post('/api/v1.0/profiles',
+                        json = {'name': 'profileA', 'attributes': {'a': '1'}})
+        r = client.post('/api/v1.0/hosts',
+                        json = { 'name': hosts, 'profiles': profiles })
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases/ipxe_boot',
+                    json={'target': 'ipxe_deploy_boot', 'hosts': 'node[0-4]'})
+    assert r.status_code == 200
+
+    for path in ('hosts', 'hosts/node[5-15]', 'aliases'):
+        expect = client.get('/api/v1.0/' + path).get_json()
+
+        r = client.get('/api/v1.0/{}?format=ndjson'.format(path))
+        assert r.status_code == 200
+        assert r.mimetype == 'application/x-ndjson'
+        lines = r.get_data(as_text=True).splitlines()
+        assert [json.loads(l) for l in lines] == expect
+
+def test_profiles_queries(client):
+    for i in range(20):
+        r = client.post('/api/v1.0/profiles',
+                        json = {'name': 'profile{}'.format(i),
+                                'attributes': {'a': str(i)}})
+        assert r.status_code == 200
+
+    # Attributes are loaded along with the profiles
+    with count_queries(client) as queries:
+        r = client.get('/api/v1.0/profiles')
+    assert r.status_code == 200
+    assert len(r.get_json()) == 20
+    assert set(p['attributes']['a'] for p in r.get_json()) == \
+        set(str(i) for i in range(20))
+    assert len(queries) == 2
+
+def test_aliases_queries(client):
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-1999]' })
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases',
+                    json={'name': 'myalias', 'target': 'ipxe_normal_boot'})
+    assert r.status_code == 200
+
+    # The number of queries does not depend on the number of overrides
+    counts = []
+    for hosts, target in (('node[0-9]', 'ipxe_deploy_boot'),
+                          ('node[10-1999]', 'kickstart')):
+        r = client.post('/api/v1.0/aliases/ipxe_boot',
+                        json={'target': target, 'hosts': hosts,
+                              'autodelete': True})
+        assert r.status_code == 200
+
+        with count_queries(client) as queries:
+            r = client.get('/api/v1.0/aliases')
+        assert r.status_code == 200
+        counts.append(len(queries))
+
+    assert counts[0] == counts[1] == 2
+    assert dict_sorted_list(r.get_json()) == dict_sorted_list([
+        {'name': 'ipxe_boot',
+         'target': 'ipxe_normal_boot',
+         'overrides': {
+             'node[0-9]': {'target': 'ipxe_deploy_boot', 'autodelete': True},
+             'node[10-1999]': {'target': 'kickstart', 'autodelete': True}}},
+        {'name': 'myalias',
+         'target': 'ipxe_normal_boot',
+         'overrides': {}}])
+
+def test_overrides_bulk_add(client):
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-2999]' })
+    assert r.status_code == 200
+
+    with count_queries(client) as queries:
+        r = client.post('/api/v1.0/aliases/ipxe_boot',
+                        json={'target': 'ipxe_deploy_boot',
+                              'hosts': 'node[0-2499]',
+                              'autodelete': True})
+    assert r.status_code == 200
+    assert r.get_json() == {'created': 2500}
+    assert len(queries) < 10
+
+    # Conflicts and missing hosts leave overrides untouched
+    r = client.post('/api/v1.0/aliases/ipxe_boot',
+                    json={'target': 'kickstart',
+                          'hosts': 'node[2000-2999]'})
+    assert r.status_code == 409
+
+    r = client.post('/api/v1.0/aliases/ipxe_boot',
+                    json={'target': 'kickstart',
+                          'hosts': 'node[2500-3000]'})
+    assert r.status_code == 404
+
+    r = client.get('/api/v1.0/aliases/ipxe_boot')
+    assert r.get_json()['overrides'] == {
+        'node[0-2499]': {'target': 'ipxe_deploy_boot', 'autodelete': True}}
+
+def render_batch(client, name, hosts, dry_run=False):
+    r = client.post('/api/v1.0/resources/{}/render'.format(name),
+                    json={'hosts': hosts, 'dry_run': dry_run})
+    if r.status_code != 200:
+        return r.status_code, r.get_json()
+
+    assert r.mimetype == 'application/x-ndjson'
+    return r.status_code, [json.loads(l)
+                           for l in r.get_data(as_text=True).splitlines()]
+
+def test_render_batch(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA', 'attributes': {'a': '1'}})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-2999]', 'profiles': ['profileA'] })
+    assert r.status_code == 200
+
+    for res in ('boot', 'deploy', 'hostname'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases',
+                    json={'name': 'myalias', 'target': 'boot'})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases/myalias',
+                    json={'target': 'deploy', 'hosts': 'node[0-1499]',
+                          'autodelete': True})
+    assert r.status_code == 200
+
+    # Hosts are resolved in bulk, whatever their number
+    with count_queries(client) as queries:
+        status, renders = render_batch(client, 'hostname', 'node[0-2999]')
+    assert status == 200
+    assert len(renders) == 3000
+    assert renders[42] == {'name': 'node42', 'resource': 'hostname',
+                           'output': 'hostname: node42'}
+    assert len(queries) <= 12
+
+    # Dry runs do not consume oneshot overrides
+    for dry_run in (True, True, False):
+        status, renders = render_batch(client, 'myalias', 'node[1498-1501]',
+                                       dry_run)
+        assert status == 200
+        assert [(r['name'], r['output']) for r in renders] == [
+            ('node1498', 'deploy: a: 1 b: '), ('node1499', 'deploy: a: 1 b: '),
+            ('node1500', 'boot: a: 1 b: '), ('node1501', 'boot: a: 1 b: ')]
+
+    status, renders = render_batch(client, 'myalias', 'node[0-2999]')
+    assert status == 200
+    assert set(r['output'] for r in renders) == set(['boot: a: 1 b: ',
+                                                     'deploy: a: 1 b: '])
+    assert len([r for r in renders if r['resource'] == 'deploy']) == 1498
+
+    r = client.get('/api/v1.0/aliases/myalias')
+    assert r.get_json()['overrides'] == {}
+
+    assert render_batch(client, 'boot', 'node[2999-3000]') == \
+        (404, {'error': 'Host not found'})
+    assert render_batch(client, 'bad', 'node0') == \
+        (404, {'error': "Resource 'bad' not found"})
+
+    template_path = client.application.config['BMGR_TEMPLATE_PATH']
+    with open(os.path.join(template_path, 'missing.jinja'), 'w+') as f:
+        f.write('missing')
+    r = client.post('/api/v1.0/resources',
+                    json = {'name': 'missing',
+                            'template_uri': 'file://missing.jinja'})
+    assert r.status_code == 200
+    os.unlink(os.path.join(template_path, 'missing.jinja'))
+    status, error = render_batch(client, 'missing', 'node0')
+    assert status == 400
+    assert error['error'].startswith('Template not found on server')
+
+def test_render_batch_errors(client, monkeypatch):
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-3]' })
+    assert r.status_code == 200
+
+    for res in ('boot', 'deploy', 'defined'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases',
+                    json={'name': 'myalias', 'target': 'boot'})
+    assert r.status_code == 200
+
+    for target, hosts in (('defined', 'node0'), ('deploy', 'node[1-2]')):
+        r = client.post('/api/v1.0/aliases/myalias',
+                        json={'target': target, 'hosts': hosts,
+                              'autodelete': True})
+        assert r.status_code == 200
+
+    # node2 loses the race for its override with a concurrent request
+    consume_overrides = bmgr.server.consume_overrides
+
+    def racing_consume_overrides(alias_ids):
+        r = client.get('/api/v1.0/resources/myalias/node2')
+        assert r.get_data(as_text=True) == 'deploy: a:  b: '
+        return consume_overrides(alias_ids)
+    monkeypatch.setattr(bmgr.server, 'consume_overrides',
+                        racing_consume_overrides)
+
+    # Overrides which fail to render are not consumed
+    status, renders = render_batch(client, 'myalias', 'node[0-3]')
+    assert status == 200
+    assert renders[0]['resource'] == 'defined'
+    assert renders[0]['error'].startswith('Error while rendering template')
+    assert renders[1:] == [
+        {'name': 'node1', 'resource': 'deploy', 'output': 'deploy: a:  b: '},
+        {'name': 'node2', 'resource': 'boot', 'output': 'boot: a:  b: '},
+        {'name': 'node3', 'resource': 'boot', 'output': 'boot: a:  b: '}]
+
+    r = client.get('/api/v1.0/aliases/myalias')
+    assert r.get_json()['overrides'] == {
+        'node0': {'target': 'defined', 'autodelete': True}}
+
+def test_render_pool(client, caplog):
+    for i in range(4):
+        r = client.post('/api/v1.0/profiles',
+                        json = {'name': 'profile{}'.format(i),
+                                'attributes': {'a': str(i)}})
+        assert r.status_code == 200
+
+        r = client.post('/api/v1.0/hosts',
+                        json = { 'name': 'node[{}-{}]'.format(i * 100,
+                                                              i * 100 + 99),
+                                 'profiles': ['profile{}'.format(i)] })
+        assert r.status_code == 200
+
+    for res in ('boot', 'hostname', 'defined'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    app = client.application
+    expected = {}
+    for res in ('boot', 'hostname', 'defined'):
+        expected[res] = render_batch(client, res, 'node[0-399]')
+        assert expected[res][0] == 200
+
+    # Rendering in worker processes gives the same results
+    pool = bmgr.server.RenderPool(2, app.config['BMGR_TEMPLATE_PATH'])
+    app.extensions['bmgr_render_pool'] = pool
+    try:
+        for res in ('boot', 'hostname', 'defined'):
+            client.delete('/api/v1.0/cache')
+            assert render_batch(client, res, 'node[0-399]') == expected[res]
+            assert pool._pool is not None
+    finally:
+        pool.close()
+
+    # Workers which cannot be started fall back to rendering in-thread
+    for executable in ('/nonexistent/python', '/bin/false'):
+        pool = bmgr.server.RenderPool(2, app.config['BMGR_TEMPLATE_PATH'],
+                                      executable=executable, start_timeout=2)
+        app.extensions['bmgr_render_pool'] = pool
+        try:
+            client.delete('/api/v1.0/cache')
+            assert render_batch(client, 'boot', 'node[0-399]') == \
+                expected['boot']
+            assert render_batch(client, 'hostname', 'node[0-399]') == \
+                expected['hostname']
+            assert pool._pool is None
+            assert caplog.text.count('Unable to start render worker '
+                                     'processes with ' + repr(executable)) == 1
+        finally:
+            pool.close()
+
+    renders = expected['defined'][1]
+    assert renders[0]['error'].startswith('Error while rendering template')
+    assert renders[0]['resource'] == 'defined'
+    assert expected['boot'][1][399]['output'] == 'boot: a: 3 b: '
+
+def test_consume_overrides_race(client):
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-9]' })
+    assert r.status_code == 200
+
+    for res in ('boot', 'deploy'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases',
+                    json={'name': 'myalias', 'target': 'boot'})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases/myalias',
+                    json={'target': 'deploy', 'hosts': 'node[0-9]',
+                          'autodelete': True})
+    assert r.status_code == 200
+
+    with client.application.app_context():
+        overrides = dict((a.host.hostname, a.id)
+                         for a in bmgr.server.Alias.query.filter(
+                                 bmgr.server.Alias.host_id!=None))
+        assert len(overrides) == 10
+
+    # A single render consumes one override after the batch resolved them
+    r = client.get('/api/v1.0/resources/myalias/node3')
+    assert r.get_data(as_text=True) == 'deploy: a:  b: '
+
+    with client.application.app_context():
+        consumed = bmgr.server.consume_overrides(list(overrides.values()))
+        assert consumed == set(i for h, i in overrides.items() if h != 'node3')
+        assert bmgr.server.consume_overrides(list(overrides.values())) == set()
+
+def test_oneshot_concurrency(client):
+    r = client.post('/api/v1.0/hosts',
+                    json = { 'name': 'node[0-1]' })
+    assert r.status_code == 200
+
+    for res in ('boot', 'deploy'):
+        r = client.post('/api/v1.0/resources',
+                        json = {'name': res,
+                                'template_uri': 'file://{}.jinja'.format(res)})
+        assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases',
+                    json={'name': 'myalias', 'target': 'boot'})
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/aliases/myalias',
+                    json={'target': 'deploy', 'hosts': 'node[0-1]',
+                          'autodelete': True})
+    assert r.status_code == 200
+
+    # Concurrent renders of the same host consume the override once
+    app = client.application
+    outputs = []
+    def fetch(hostname):
+        r = app.test_client().get('/api/v1.0/resources/myalias/' + hostname)
+        outputs.append((hostname, r.status_code, r.get_data(as_text=True)))
+
+    threads = [threading.Thread(target=fetch, args=(h,))
+               for h in ['node0', 'node1'] * 8]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for hostname in ('node0', 'node1'):
+        renders = [o[1:] for o in outputs if o[0] == hostname]
+        assert len(renders) == 8
+        assert renders.count((200, 'deploy: a:  b: ')) == 1
+        assert renders.count((200, 'boot: a:  b: ')) == 7
+
+    r = client.get('/api/v1.0/aliases/myalias')
+    assert r.get_json()['overrides'] == {}
+
+def test_upgrade_db(client):
+    db = bmgr.server.db
+    table = bmgr.server.host_profiles_table
+    hosts = nodeset('node[0-99999]')
+
+    with client.application.app_context():
+        assert migrations.current_version() == migrations.latest_version()
+        assert migrations.upgrade_db() == []
+
+        # Bring the database back to the initial schema
+        for index in ('ix_host_profiles_host_profile',
+                      'ix_host_profiles_profile_id',
+                      'ix_aliases_host_id',
+                      'ix_aliases_target_id'):
+            db.session.execute('DROP INDEX {}'.format(index))
+        db.session.execute('DROP TABLE schema_version')
+        db.session.execute('DROP TABLE change_counters')
+
+        # Generate a large inventory with duplicated associations
+        db.session.execute(bmgr.server.Profile.__table__.insert(),
+                           [{'name': 'profile{}'.format(i),
+                             'attributes': {'p': str(i)},
+                             'weight': 0} for i in range(2)])
+        bmgr.server.insert_hosts(hosts, [bmgr.server.get_profile('profile0')])
+        db.session.execute(table.insert(),
+                           [{'host_id': i, 'profile_id': 1}
+                            for i in range(1, 2500)])
+        db.session.execute('ALTER TABLE profiles DROP COLUMN version')
+        db.session.commit()
+        assert db.session.query(table).count() == 102499
+        assert migrations.current_version() == 0
+
+        applied = migrations.upgrade_db(batch_size=1000)
+        assert [m.version for m in applied] == [1, 2, 3]
+        assert migrations.current_version() == 3
+
+        indexes = set(i['name'] for t in ('host_profiles', 'aliases')
+                      for i in inspect(db.engine).get_indexes(t))
+        assert indexes >= set(['ix_host_profiles_host_profile',
+                               'ix_host_profiles_profile_id',
+                               'ix_aliases_host_id',
+                               'ix_aliases_target_id'])
+        assert db.session.query(table).count() == 100000
+        assert db.session.query(table.c.host_id).distinct().count() == 100000
+
+        profiles = db.session.query(bmgr.server.Profile).all()
+        assert len(set(p.version for p in profiles if p.version)) == 2
+        assert [p.attributes for p in profiles] == [{'p': '0'}, {'p': '1'}]
+
+        counters = bmgr.server.change_counters_table
+        assert sorted(n for (n,) in db.session.query(counters.c.name)) == \
+            sorted(bmgr.server.CHANGE_COUNTERS)
+
+def test_profile_merge_patch(client):
+    r = client.post('/api/v1.0/profiles',
+                    json = {'name': 'profileA',
+                            'attributes': {'a': '1', 'b': '2',
+                                           'n': {'x': '1', 'y': '2'}}})
+    assert r.status_code == 200
+
+    r = client.get('/api/v1.0/profiles/profileA')
+    version = r.headers['ETag']
+
+    # Keys are set or deleted individually, nested objects are patched
+    r = client.patch('/api/v1.0/profiles/profileA',
+                     content_type = 'application/merge-patch+json',
+                     data = json.dumps({'attributes': {'a': '3', 'b': None,
+                                                       'c': '4',
+                                                       'n': {'y': None}}}))
+    assert r.status_code == 200
+    assert r.get_json()['attributes'] == {'a': '3', 'c': '4',
+                                          'n': {'x': '1'}}
+    assert r.headers['ETag'] != version
+
+    r = client.get('/api/v1.0/profiles/profileA')
+    assert r.get_json()['attributes'] == {'a': '3', 'c': '4',
+                                          'n': {'x': '1'}}
+    assert r.headers['ETag'] != version
+
+    # Updates of an outdated version are rejected
+    r = client.patch('/api/v1.0/profiles/profileA',
+                     content_type = 'application/merge-patch+json',
+                     headers = {'If-Match': version},
+                     data = json.dumps({'attributes': {'a': '5'}}))
+    assert r.status_code == 412
+    assert r.get_json() == {'error': "Profile 'profileA' was modified"}
+
+    version = client.get('/api/v1.0/profiles/profileA').headers['ETag']
+    r = client.patch('/api/v1.0/profiles/profileA',
+                     content_type = 'application/merge-patch+json',
+                     headers = {'If-Match': version},
+                     data = json.dumps({'attributes': {'a': '5'},
+                                        'weight': 3}))
+    assert r.status_code == 200
+    assert r.get_json() == {'name': 'profileA', 'weight': 3,
+                            'attributes': {'a': '5', 'c': '4',
+                                           'n': {'x': '1'}}}
+
+    # Plain JSON still replaces all the attributes
+    r = client.patch('/api/v1.0/profiles/profileA',
+                     json = {'attributes': {'d': '6'}})
+    assert r.status_code == 200
+    assert r.get_json()['attributes'] == {'d': '6'}
+
+    r = client.get('/api/v1.0/profiles/profileA',
+                   headers = {'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+def test_batch(client):
+    r = client.post('/api/v1.0/hosts', json = {'name': 'node[0-9]'})
+    assert r.status_code == 200
+
+    operations = [
+        {'method': 'POST', 'path': '/api/v1.0/profiles',
+         'body': {'name': 'deploy', 'attributes': {'a': '1'}}},
+        {'method': 'PATCH', 'path': '/api/v1.0/hosts/node[0-4]',
+         'body': {'profiles': ['deploy']}},
+        {'method': 'POST', 'path': '/api/v1.0/aliases/ipxe_boot',
+         'body': {'hosts': 'node[0-4]', 'target': 'ipxe_deploy_boot',
+                  'autodelete': True}},
+        {'method': 'DELETE', 'path': '/api/v1.0/hosts/node9'}]
+
+    # The operations are committed at once
+    commits = []
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    with client.application.app_context():
+        engine = bmgr.server.db.engine
+    event.listen(engine, 'commit', on_commit)
+    try:
+        r = client.post('/api/v1.0/batch', json = {'operations': operations})
+    finally:
+        event.remove(engine, 'commit', on_commit)
+    assert r.status_code == 200
+    assert len(commits) == 1
+    assert r.get_json() == [
+        {'status': 200, 'body': {'name': 'deploy', 'attributes': {'a': '1'},
+                                 'weight': 0}},
+        {'status': 200, 'body': [{'name': 'node[0-4]',
+                                  'profiles': ['deploy'],
+                                  'attributes': {'a': '1'}}]},
+        {'status': 200, 'body': {'created': 5}},
+        {'status': 204, 'body': None}]
+
+    r = client.get('/api/v1.0/hosts')
+    assert r.get_json() == [{'name': 'node[5-8]', 'profiles': [],
+                             'attributes': {}},
+                            {'name': 'node[0-4]', 'profiles': ['deploy'],
+                             'attributes': {'a': '1'}}]
+    r = client.get('/api/v1.0/aliases/ipxe_boot')
+    assert r.get_json()['overrides'] == {
+        'node[0-4]': {'target': 'ipxe_deploy_boot', 'autodelete': True}}
+
+    # A failing operation discards the previous ones
+    r = client.post('/api/v1.0/batch', json = {'operations': [
+        {'method': 'POST', 'path': '/api/v1.0/profiles',
+         'body': {'name': 'other'}},
+        {'method': 'DELETE', 'path': '/api/v1.0/aliases/ipxe_boot/node[5-8]'},
+        {'method': 'DELETE', 'path': '/api/v1.0/hosts/node[0-4]'}]})
+    assert r.status_code == 404
+    assert r.get_json()['operation'] == 1
+    assert r.get_json()['error'].startswith(
+        'Operation 1 (DELETE /api/v1.0/aliases/ipxe_boot/node[5-8]): ')
+
+    r = client.get('/api/v1.0/profiles/other')
+    assert r.status_code == 404
+    r = client.get('/api/v1.0/hosts/node[0-4]')
+    assert r.status_code == 200
+
+    r = client.post('/api/v1.0/batch', json = {'operations': [
+        {'method': 'DELETE', 'path': '/api/v1.0/cache'}]})
+    assert r.status_code == 400
+    assert r.get_json()['error'] == \
+        'Operation 0 (DELETE /api/v1.0/cache): Operation not allowed in a batch'
+
+    r = client.post('/api/v1.0/batch', json = {'operations': [
+        {'method': 'GET', 'path': '/api/v1.0/hosts'}]})
+    assert r.status_code == 400
+
+    # Operations are sent with their headers, such as the merge patch
+    # content type and the version of the profile to update
+    version = client.get('/api/v1.0/profiles/deploy').headers['ETag']
+    merge_patch = {'method': 'PATCH', 'path': '/api/v1.0/profiles/deploy',
+                   'body': {'attributes': {'b': '2'}},
+                   'headers': {'Content-Type': 'application/merge-patch+json',
+                               'If-Match': version}}
+    r = client.post('/api/v1.0/batch', json = {'operations': [merge_patch]})
+    assert r.status_code == 200
+    assert r.get_json()[0]['body']['attributes'] == {'a': '1', 'b': '2'}
+
+    r = client.post('/api/v1.0/batch', json = {'operations': [merge_patch]})
+    assert r.status_code == 412
+    assert client.get('/api/v1.0/profiles/deploy').get_json()['attributes'] \
+        == {'a': '1', 'b': '2'}
+
+    r = client.post('/api/v1.0/batch', json = {'operations': [
+        {'method': 'DELETE', 'path': '/api/v1.0/hosts/node0',
+         'headers': {'Host': 'example.com'}}]})
+    assert r.status_code == 400
+
+def test_inventory(client):
+    r = client.get('/api/v1.0/inventory')
+    assert r.status_code == 200
+    assert r.get_json()['hosts'] == []
+    assert r.get_json()['profiles'] == []
+    resources = r.get_json()['resources']
+    aliases = r.get_json()['aliases']
+
+    inventory = {
+        'profiles': [{'name': 'profileA', 'attributes': {'a': '1'},
+                      'weight': 0},
+                     {'name': 'profileB', 'attributes': {'b': '2'},
+                      'weight': 10}],
+        'resources': [{'name': 'boot',
+                       'template_uri': 'file://boot.jinja'}] + resources,
+        'hosts': [{'name': 'node[0-9]', 'profiles': ['profileA']},
+                  {'name': 'node[10-19]',
+                   'profiles': ['profileB', 'profileA']}],
+        'aliases': aliases + [{'name': 'next', 'target': 'kickstart',
+                               'overrides': {'node[0-4]': {
+                                   'target': 'boot',
+                                   'autodelete': True}}}]}
+
+    def changes(added=(0, 0, 0, 0, 0), updated=(0, 0, 0, 0, 0),
+                deleted=(0, 0, 0, 0, 0)):
+        kinds = ('resources', 'profiles', 'hosts', 'aliases', 'overrides')
+        return dict((kind, {'added': added[i], 'updated': updated[i],
+                            'deleted': deleted[i]})
+                    for i, kind in enumerate(kinds))
+
+    # A dry run only returns the changes
+    r = client.put('/api/v1.0/inventory?dry_run=true', json = inventory)
+    assert r.status_code == 200
+    assert r.get_json() == changes(added=(1, 2, 20, 1, 5))
+    assert client.get('/api/v1.0/inventory').get_json()['hosts'] == []
+
+    r = client.put('/api/v1.0/inventory', json = inventory)
+    assert r.status_code == 200
+    assert r.get_json() == changes(added=(1, 2, 20, 1, 5))
+
+    r = client.get('/api/v1.0/inventory')
+    assert r.get_json() == inventory
+    etag = r.headers['ETag']
+
+    r = client.get('/api/v1.0/hosts/node15')
+    assert r.get_json()[0]['attributes'] == {'a': '1', 'b': '2'}
+    assert client.get('/api/v1.0/resources/next/node1').get_data() == \
+        b'boot: a: 1 b: '
+
+    # Importing the same inventory again only restores the consumed override
+    r = client.put('/api/v1.0/inventory', json = inventory)
+    assert r.get_json() == changes(added=(0, 0, 0, 0, 1))
+    r = client.put('/api/v1.0/inventory', json = inventory)
+    assert r.get_json() == changes()
+
+    inventory['profiles'] = [{'name': 'profileA', 'attributes': {'a': '3'},
+                              'weight': 0}]
+    inventory['hosts'] = [{'name': 'node[5-9,20]', 'profiles': []},
+                          {'name': 'node[0-4]', 'profiles': ['profileA']}]
+    inventory['aliases'][-1]['overrides'] = {
+        'node[0-1]': {'target': 'boot', 'autodelete': False},
+        'node2': {'target': 'boot', 'autodelete': True}}
+    inventory['resources'] = [res for res in inventory['resources']
+                              if res['name'] != 'poap_config']
+    r = client.put('/api/v1.0/inventory', json = inventory)
+    assert r.status_code == 200
+    assert r.get_json() == changes(added=(0, 0, 1, 0, 0),
+                                   updated=(0, 1, 5, 0, 2),
+                                   deleted=(1, 1, 10, 0, 2))
+
+    r = client.get('/api/v1.0/inventory', headers = {'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.get_json() == inventory
+    r = client.get('/api/v1.0/hosts/node1')
+    assert r.get_json()[0]['attributes'] == {'a': '3'}
+
+    # Inconsistent inventories are rejected
+    for hosts, aliases, error in [
+            ([{'name': 'node1', 'profiles': ['profileC']}], [],
+             "Profile 'profileC' not found"),
+            ([{'name': 'node[0-1]'}, {'name': 'node1'}], [],
+             "Duplicate host 'node1'"),
+            ([], [{'name': 'boot', 'target': 'other'}],
+             "Resource 'other' not found"),
+            ([], [{'name': 'boot', 'target': 'kickstart',
+                   'overrides': {'node1': {'target': 'kickstart'}}}],
+             "Host 'node1' not found")]:
+        r = client.put('/api/v1.0/inventory',
+                       json = dict(inventory, hosts=hosts, aliases=aliases))
+        assert r.status_code == 400
+        assert r.get_json() == {'error': error}
+
+    r = client.get('/api/v1.0/inventory')
+    assert r.get_json() == inventory
+